@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+
+from sql import Table, Columns
+
+
+TABLE = Table('t', Columns('id INTEGER', 'name TEXT', 'value REAL'))
+JOINED = Table('j', Columns('id INTEGER', 't_id INTEGER'))
+
+
+def build(steps):
+    query = TABLE.select(TABLE.c.id, TABLE.c.name)
+    for i in range(steps):
+        if i % 4 == 0:
+            query = query.where(TABLE.c.value > i)
+        elif i % 4 == 1:
+            query = query.order_by(TABLE.c.name)
+        elif i % 4 == 2:
+            query = query.group_by(TABLE.c.id)
+        else:
+            query = query.join(JOINED).on(JOINED.c.t_id == TABLE.c.id)
+    return query
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time of long programmatic builder chains')
+    parser.add_argument('--steps', type=int, nargs='+', default=[100, 1_000, 10_000])
+    args = parser.parse_args()
+    for steps in args.steps:
+        start = time.perf_counter()
+        build(steps)
+        elapsed = time.perf_counter() - start
+        print(f'{steps:>8} steps {elapsed:10.4f} s {elapsed / steps * 1e6:10.2f} us/step')
+
+
+if __name__ == '__main__':
+    main()
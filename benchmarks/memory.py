@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import argparse
+import gc
+import tracemalloc
+
+from sql import Table, Columns, Column, Aggregate, Order
+from sql.core import Field, Condition, Operation, And, FieldsList
+from sql.queries import Ordering
+
+
+TABLE = Table('t', Columns('id INTEGER', 'name TEXT', 'value REAL'))
+
+
+NODES = {
+    'Field': lambda i: Field('f', TABLE),
+    'Alias': lambda i: TABLE.c.id.alias('a'),
+    'Column': lambda i: Column('c', 'INTEGER'),
+    'Condition': lambda i: Condition('=', TABLE.c.id, i),
+    'Operation': lambda i: Operation('+', TABLE.c.value, i),
+    'Aggregate': lambda i: Aggregate('SUM', TABLE.c.value),
+    'Ordering': lambda i: Ordering(TABLE.c.id, order=Order.DESC),
+    'And': lambda i: And(),
+    'FieldsList': lambda i: FieldsList(),
+}
+
+
+def measure(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    nodes = [factory(i) for i in range(count)]
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Do not count the list holding nodes (one pointer per node)
+    return (size - (count * 8)) / count, nodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory used per expression tree node')
+    parser.add_argument('--count', type=int, default=100_000)
+    args = parser.parse_args()
+    for name, factory in NODES.items():
+        size, nodes = measure(factory, args.count)
+        print(f'{name:<12} {size:8.1f} bytes/node')
+
+
+if __name__ == '__main__':
+    main()
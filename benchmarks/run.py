@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sql
+from sql import Table, Columns, And, Or, DB
+
+import builder
+
+
+TABLE = Table('t', Columns(
+    'id INTEGER PRIMARY KEY',
+    'name TEXT',
+    'value REAL',
+    *[f'c{i} INTEGER' for i in range(200)]
+))
+JOINED = Table('j', Columns('id INTEGER PRIMARY KEY', 't_id INTEGER', 'label TEXT'))
+
+
+def build_chain():
+    return TABLE.select(TABLE.c.id, TABLE.c.name). \
+        where(TABLE.c.value > 10). \
+        join(JOINED).on(JOINED.c.t_id == TABLE.c.id). \
+        order_by(TABLE.c.name)
+
+
+def build_long_chain():
+    return builder.build(1000)
+
+
+WIDE_SELECT = TABLE.select(*TABLE.columns).where(TABLE.c.id > 10).order_by(TABLE.c.name)
+
+
+def render_wide_select():
+    # Copy drops the render cache
+    return copy.copy(WIDE_SELECT).sql()
+
+
+def deep_tree(terms):
+    conditions = TABLE.c.id == 0
+    for i in range(1, terms):
+        if i % 2:
+            conditions = Or([conditions, TABLE.c.value > i])
+        else:
+            conditions = And([conditions, TABLE.c.name == i])
+    return TABLE.select().where(conditions)
+
+
+DEEP_TREE = deep_tree(1000)
+
+
+def render_deep_tree():
+    return copy.copy(DEEP_TREE).sql()
+
+
+def render_deep_tree_with_params():
+    return copy.copy(DEEP_TREE).sql_with_params()
+
+
+INSERT = TABLE.insert(TABLE.c.id, TABLE.c.name, TABLE.c.value)
+INSERT_ROWS = [(i, f'name {i}', i / 10) for i in range(1000)]
+
+
+def render_insert():
+    return copy.copy(INSERT.values(1, "'name'", 0.1)).sql()
+
+
+def render_insert_batches():
+    return list(INSERT.batches(INSERT_ROWS))
+
+
+def hash_nodes():
+    # New nodes, so fingerprints are not cached
+    return [hash((TABLE.c.id + i) * 2 == TABLE.c.value) for i in range(100)]
+
+
+class ExecuteBenchmark:
+
+    def __init__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = DB(os.path.join(self.directory.name, 'bench.db'), TABLE, JOINED, parameterize=True)
+        self.db.execute_many(
+            TABLE.insert(TABLE.c.id, TABLE.c.name, TABLE.c.value).values('?', '?', '?'),
+            INSERT_ROWS,
+        )
+        self.i = 0
+
+    def select_by_id(self):
+        self.i = (self.i + 1) % len(INSERT_ROWS)
+        return self.db.execute_query(TABLE.select().where(TABLE.c.id == self.i)).fetchall()
+
+    def select_range(self):
+        return self.db.execute_query(
+            TABLE.select(TABLE.c.id, TABLE.c.name).where(TABLE.c.value < 50).order_by(TABLE.c.name)
+        ).fetchall()
+
+    def update(self):
+        self.i = (self.i + 1) % len(INSERT_ROWS)
+        self.db.execute_query(TABLE.update({TABLE.c.value: self.i}).where(TABLE.c.id == self.i))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+        self.directory.cleanup()
+
+
+def benchmarks(execute):
+    return {
+        'build.chain': build_chain,
+        'build.long_chain': build_long_chain,
+        'render.wide_select': render_wide_select,
+        'render.deep_tree': render_deep_tree,
+        'render.deep_tree_with_params': render_deep_tree_with_params,
+        'render.insert': render_insert,
+        'render.insert_batches': render_insert_batches,
+        'hash.nodes': hash_nodes,
+        'execute.select_by_id': execute.select_by_id,
+        'execute.select_range': execute.select_range,
+        'execute.update': execute.update,
+    }
+
+
+def calibrate(func, min_time):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        if time.perf_counter() - start >= min_time:
+            return number
+        number *= 2
+
+
+def measure(func, repeat, min_time):
+    number = calibrate(func, min_time)
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    tracemalloc.start()
+    func()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'number': number,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'peak_bytes': peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['min'] / baseline[name]['min']
+        marker = ''
+        if ratio > threshold:
+            marker = ' REGRESSION'
+            regressions.append(name)
+        print(f'{name:<32} {ratio:8.2f}x{marker}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of building, rendering and executing queries')
+    parser.add_argument('names', nargs='*', help='run only benchmarks with names starting with these prefixes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1, help='minimal time of single round (seconds)')
+    parser.add_argument('--json', help='save results as JSON')
+    parser.add_argument('--compare', help='compare with baseline saved with --json')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as regression')
+    args = parser.parse_args()
+
+    execute = ExecuteBenchmark()
+    try:
+        results = {}
+        for name, func in benchmarks(execute).items():
+            if args.names and not name.startswith(tuple(args.names)):
+                continue
+            result = measure(func, args.repeat, args.min_time)
+            results[name] = result
+            print(f'{name:<32} {result["min"]*1e6:12.2f} us {result["median"]*1e6:12.2f} us (median) '
+                  f'{result["peak_bytes"]:>10} B peak')
+    finally:
+        execute.close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'sqlite': sql.db.sqlite3.sqlite_version,
+                'version': sql.__version__,
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
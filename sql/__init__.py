@@ -13,6 +13,13 @@ from .parameters import get_parameters_builder
 
 from .queries import CreateTable, CreateIndex, DropTable, DropIndex
 from .queries import Select, Insert, Update, Delete
+from .queries import CompiledQuery
+
+from .converters import Converters, register_converter
 
 from .db import DB
+from .instrumentation import Instrumentation
+from .cache import ResultCache
+from .asyncdb import AsyncDB
+from .sharding import ShardedDB
 
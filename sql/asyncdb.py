@@ -0,0 +1,141 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import logging
+
+from .db import DB
+from .pool import Result
+
+
+log = logging.getLogger('sql.asyncdb')
+
+
+class Worker:
+
+    # Single thread owning its own DB connection
+
+    def __init__(self, db):
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='sql-asyncdb',
+        )
+        self._transaction = None
+        # Connection is opened by the worker thread, one worker after another,
+        # so the schema is created only once
+        self.executor.submit(self._connect).result()
+
+    def _connect(self):
+        # In WAL mode reads don't block the writer and the other way round
+        self.db.connection.execute('PRAGMA journal_mode=WAL')
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(func, *args, **kwargs),
+        )
+
+    def execute(self, query, params, commit=False):
+        result = Result(self.db.execute_query(query, *params))
+        if commit and self.db.connection.in_transaction:
+            self.db.commit()
+        return result
+
+    def begin(self):
+        # Write lock is taken right away, so concurrent read-then-write transactions
+        # wait for each other instead of failing to upgrade their read locks
+        self._transaction = self.db.transaction(mode='IMMEDIATE')
+        self._transaction.__enter__()
+
+    def end(self, error=None):
+        transaction, self._transaction = self._transaction, None
+        if error is None:
+            transaction.__exit__(None, None, None)
+        else:
+            transaction.__exit__(type(error), error, error.__traceback__)
+
+    async def stream(self, query, params, batch_size=None):
+        cursor = await self.run(self.db.execute_query, query, *params)
+        try:
+            while True:
+                batch = await self.run(cursor.fetchmany, batch_size or self.db.BATCH_SIZE)
+                if not batch:
+                    return
+                for row in batch:
+                    yield row
+        finally:
+            await self.run(cursor.close)
+
+    def close(self):
+        self.executor.submit(self.db.close).result()
+        self.executor.shutdown()
+
+
+class Transaction:
+
+    def __init__(self, worker):
+        self._worker = worker
+
+    async def execute(self, query, *params):
+        return await self._worker.run(self._worker.execute, query, params)
+
+    async def stream(self, query, *params, batch_size=None):
+        async for row in self._worker.stream(query, params, batch_size):
+            yield row
+
+
+class AsyncDB:
+
+    WORKERS = 4
+
+    def __init__(self, fn, *tables, indexes=None, workers=None):
+        self.fn = fn
+        self._workers = [
+            Worker(DB(fn, *tables, indexes=indexes))
+            for i in range(workers or self.WORKERS)
+        ]
+        self._idle = None
+
+    @contextlib.asynccontextmanager
+    async def _worker(self):
+        # Callers wait here for an idle worker, so no more than `workers`
+        # queries are executing, while the rest is queued in the event loop
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in self._workers:
+                self._idle.put_nowait(worker)
+        worker = await self._idle.get()
+        try:
+            yield worker
+        finally:
+            self._idle.put_nowait(worker)
+
+    async def execute(self, query, *params):
+        async with self._worker() as worker:
+            return await worker.run(worker.execute, query, params, commit=True)
+
+    async def stream(self, query, *params, batch_size=None):
+        async with self._worker() as worker:
+            async for row in worker.stream(query, params, batch_size):
+                yield row
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        async with self._worker() as worker:
+            await worker.run(worker.begin)
+            try:
+                yield Transaction(worker)
+            except BaseException as error:
+                await worker.run(worker.end, error)
+                raise
+            else:
+                await worker.run(worker.end)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(None, worker.close)
+            for worker in self._workers
+        ])
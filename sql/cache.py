@@ -0,0 +1,149 @@
+import collections
+import logging
+import threading
+import time
+
+from .core import _fingerprint_parts
+from .tables import Table
+
+
+log = logging.getLogger('sql.cache')
+
+
+def table_names(query):
+    # Names of all tables query depends on: FROM and joined tables, and tables
+    # of subqueries anywhere in the query (conditions, IN, EXISTS, ...)
+    query = getattr(query, 'query', query)
+    names = set()
+    seen = set()
+    nodes = [query, ]
+    while nodes:
+        node = nodes.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, Table):
+            names.add(node.name)
+            continue
+        if hasattr(node, '_tables'):
+            nodes.extend(table for table in node._tables() if table is not None)
+        parts = _fingerprint_parts(node)
+        if parts is not None:
+            nodes.extend(parts[1])
+    return names
+
+
+class ResultCache:
+
+    # LRU cache of fetched results keyed by SQL and params, evicted when
+    # older than ttl (in seconds), or when any of its tables is written to
+
+    def __init__(self, max_size=1000, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expires, tables, value)
+        self._entries = collections.OrderedDict()
+        # table name -> keys
+        self._keys = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        # Incremented on each invalidation, results read before it are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(sql, params, *args):
+        # Returns None for unhashable params
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        key = (sql, tuple(params), *args)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _remove(self, key):
+        expires, tables, value = self._entries.pop(key)
+        for table in tables:
+            keys = self._keys.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys[table]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, tables, value = entry
+            if expires is not None and expires <= self.clock():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, tables, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                # Tables were written to while query was executing
+                return False
+            if key in self._entries:
+                self._remove(key)
+            expires = self.ttl is not None and self.clock() + self.ttl or None
+            self._entries[key] = (expires, tables, value)
+            for table in tables:
+                self._keys[table].add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def invalidate(self, tables):
+        with self._lock:
+            self.generation += 1
+            for table in tables:
+                for key in list(self._keys.get(table, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys.clear()
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': lookups and self.hits / lookups or None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,131 @@
+import datetime
+import logging
+import threading
+import weakref
+
+from .core import Alias
+from .tables import Column, Columns
+
+
+log = logging.getLogger('sql.converters')
+
+
+def normalize(data_type):
+    # Like sqlite3 with PARSE_DECLTYPES: first word of declared type, without size
+    return data_type.split('(', 1)[0].split(maxsplit=1)[0].upper()
+
+
+def to_date(value):
+    return datetime.date.fromisoformat(value)
+
+
+def to_datetime(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+class Converters:
+
+    # Converters of values returned by SQLite, keyed by data type of the column.
+    # Unlike sqlite3 converters they get values as returned (int, float, str, bytes),
+    # and are not called for NULLs
+
+    # Same as default sqlite3 converters
+    DEFAULTS = {
+        'DATE': to_date,
+        'TIMESTAMP': to_datetime,
+    }
+
+    def __init__(self, converters=None, defaults=True):
+        self._converters = {}
+        # Plans are cached on queries, and discarded when version changes
+        self._version = 0
+        # Columns of table -> converters of its columns by name
+        self._tables = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        for data_type, converter in {**(defaults and self.DEFAULTS or {}), **(converters or {})}.items():
+            self.register(data_type, converter)
+
+    def register(self, data_type, converter):
+        with self._lock:
+            self._converters[normalize(data_type)] = converter
+            self._version += 1
+            self._tables = weakref.WeakKeyDictionary()
+
+    def unregister(self, data_type):
+        with self._lock:
+            self._converters.pop(normalize(data_type), None)
+            self._version += 1
+            self._tables = weakref.WeakKeyDictionary()
+
+    def get(self, data_type):
+        if not data_type:
+            return None
+        return self._converters.get(normalize(data_type))
+
+    def result_columns(self, query):
+        # Column definitions of values returned by query, None for computed
+        # values. Returns None when position of values can't be determined
+        columns = []
+        for column in query.columns:
+            if isinstance(column, Alias):
+                column = column.target
+            if isinstance(column, Column):
+                columns.append(column)
+            elif isinstance(column, Columns) or isinstance(column, str) and column == '*':
+                for table in query._tables():
+                    table = getattr(table, 'target', table)
+                    if not isinstance(getattr(table, 'columns', None), Columns):
+                        return None
+                    columns.extend(table.columns)
+            elif isinstance(column, str) and column.endswith('*'):
+                # Like "users.*"
+                return None
+            else:
+                columns.append(None)
+        return columns
+
+    def table_converters(self, table):
+        # Returns dict of column name -> converter for columns of the table
+        columns = getattr(getattr(table, 'target', table), 'columns', None)
+        if not isinstance(columns, Columns):
+            return {}
+        tables = self._tables
+        converters = tables.get(columns)
+        if converters is None:
+            converters = tables[columns] = {
+                column.name: converter
+                for column, converter in ((column, self.get(column.data_type)) for column in columns)
+                if converter is not None
+            }
+        return converters
+
+    def plan(self, query):
+        # Returns tuple of (position, converter) for values that need conversion,
+        # or None when there is nothing to convert. Plan is cached on the query
+        query = getattr(query, 'query', query)
+        if not hasattr(query, 'columns') or not getattr(query, 'READ_ONLY', False):
+            return None
+        version = self._version
+        cached = query.__dict__.get('_conversions')
+        if cached is not None and cached[0] is self and cached[1] == version:
+            return cached[2]
+        plan = None
+        if any(self.table_converters(table) for table in query._tables() if table is not None):
+            plan = []
+            for position, column in enumerate(self.result_columns(query) or ()):
+                if column is None:
+                    continue
+                if column.table is None:
+                    converter = self.get(column.data_type)
+                else:
+                    converter = self.table_converters(column.table).get(column.name)
+                if converter is not None:
+                    plan.append((position, converter))
+            plan = tuple(plan) or None
+        query.__dict__['_conversions'] = (self, version, plan)
+        return plan
+
+
+CONVERTERS = Converters()
+
+register_converter = CONVERTERS.register
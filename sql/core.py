@@ -1,3 +1,7 @@
+import datetime
+import functools
+import hashlib
+import json
 import logging
 
 
@@ -18,13 +22,224 @@ def to_sql(e, **kwargs):
     return e
 
 
+def to_value_sql(e, literals=None, **kwargs):
+    # With literals collector non-Sql values are replaced with placeholders
+    if literals is not None and not hasattr(e, 'sql'):
+        return literals(e)
+    return to_sql(e, literals=literals, **kwargs)
+
+
+def render(e, parenthesis=False, value=False, **kwargs):
+    # Non-recursive renderer for Expression, FieldsList and ConditionsList trees,
+    # any other node (or subclass with its own sql()) is rendered using to_sql()
+    # Expression operands (and items of lists with value=True) are values
+    parts = []
+    stack = [(e, parenthesis, value), ]
+    while stack:
+        e = stack.pop()
+        if e.__class__ is str:
+            parts.append(e)
+            continue
+        e, parenthesis, value = e
+        renderer = getattr(e.__class__, 'sql', None)
+        if renderer is Expression.sql:
+            if parenthesis:
+                stack.append(')')
+            stack.extend([
+                (e.right, True, True),
+                f' {e.operator} ',
+                (e.left, True, True),
+            ])
+            if parenthesis:
+                stack.append('(')
+        elif renderer is ConditionsList.sql:
+            if parenthesis:
+                stack.append(')')
+            separator = f' {e.OPERATOR} '
+            for i, condition in enumerate(reversed(e)):
+                if i:
+                    stack.append(separator)
+                stack.append((condition, isinstance(condition, ConditionsList), False))
+            if parenthesis:
+                stack.append('(')
+        elif renderer is FieldsList.sql:
+            for i, field in enumerate(reversed(e)):
+                if i:
+                    stack.append(', ')
+                stack.append((field, parenthesis, value))
+        elif value and renderer is None:
+            parts.append(f'{to_value_sql(e, **kwargs)}')
+        elif parenthesis:
+            parts.append(f'{to_sql(e, parenthesis=True, **kwargs)}')
+        else:
+            parts.append(f'{to_sql(e, **kwargs)}')
+    return ''.join(parts)
+
+
+@functools.lru_cache(maxsize=4096)
+def _stable_hash(text):
+    # Unlike hash() of str it doesn't change between processes
+    return int.from_bytes(
+        hashlib.blake2b(text.encode(), digest_size=8).digest(),
+        'big',
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _data_hash(data):
+    # Node data repeats a lot (class names, operators), so it's hashed once
+    return _stable_hash(repr(data))
+
+
+def _digest(data, children=()):
+    # hash() of tuple of ints is stable between processes
+    try:
+        data = _data_hash(data)
+    except TypeError:
+        # Unhashable data
+        data = _stable_hash(repr(data))
+    return hash((data, *children))
+
+
+def _fingerprint_parts(e):
+    # Returns (data, children) of a node, or None for literal values
+    if hasattr(e, '_fingerprint_parts'):
+        return e._fingerprint_parts()
+    if isinstance(e, (list, tuple)):
+        # Strings in lists are SQL snippets (like '*'), not values
+        data = [e.__class__.__name__, ]
+        children = []
+        for i, item in enumerate(e):
+            if isinstance(item, str):
+                data.append((i, item))
+            else:
+                children.append(item)
+        return tuple(data), children
+    if isinstance(e, dict):
+        return (e.__class__.__name__, ), [item for items in e.items() for item in items]
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _literal_shape(cls):
+    return _digest(('literal', cls.__name__))
+
+
+# Literals hashed directly, hash() of numbers is stable between processes
+NUMBERS = {int, float, bool, }
+
+
+def _literal(value):
+    shape = _literal_shape(value.__class__)
+    if value is None:
+        return hash((shape, 0)), shape
+    if value.__class__ in NUMBERS:
+        return hash((shape, value)), shape
+    return hash((shape, _stable_hash(repr(value)))), shape
+
+
+def fingerprints(e):
+    # Returns (fingerprint, shape) of e, combined bottom-up from its children,
+    # shape ignores literal values. Computed without recursion, and cached on
+    # nodes that allow it. Cached and literal children are resolved right away,
+    # only other nodes go to the stack
+    cached = getattr(e, '_fingerprints', None)
+    if cached is not None:
+        return cached
+    parts = _fingerprint_parts(e)
+    if parts is None:
+        return _literal(e)
+    # Results of nodes computed on the stack, by id
+    results = {}
+    # Node, its parts and results of its children (None for pending ones),
+    # children are resolved on the first visit of the node
+    stack = [(e, parts, None), ]
+    while stack:
+        node, parts, resolved = stack[-1]
+        data, children = parts
+        if resolved is None:
+            position = len(stack) - 1
+            resolved = []
+            pending = False
+            for child in children:
+                if child.__class__ in NUMBERS or child is None:
+                    resolved.append(_literal(child))
+                    continue
+                cached = getattr(child, '_fingerprints', None)
+                if cached is None:
+                    cached = results.get(id(child))
+                if cached is None:
+                    child_parts = _fingerprint_parts(child)
+                    if child_parts is not None:
+                        stack.append((child, child_parts, None))
+                        pending = True
+                    else:
+                        cached = _literal(child)
+                resolved.append(cached)
+            if pending:
+                # Visit node again when all its children are done
+                stack[position] = (node, parts, resolved)
+                continue
+        stack.pop()
+        child_fingerprints = []
+        shapes = []
+        for child, result in zip(children, resolved):
+            fingerprint, shape = result or results[id(child)]
+            child_fingerprints.append(fingerprint)
+            shapes.append(shape)
+        fingerprint = _digest(data, child_fingerprints)
+        if child_fingerprints == shapes:
+            # No literals in this subtree
+            result = (fingerprint, fingerprint)
+        else:
+            result = (fingerprint, _digest(data, shapes))
+        try:
+            node._fingerprints = result
+        except AttributeError:
+            pass
+        results[id(node)] = result
+    return results[id(e)]
+
+
+@functools.lru_cache(maxsize=None)
+def _slots(cls):
+    # Names of all slots of the class, except caches
+    return tuple(
+        name
+        for base in reversed(cls.__mro__)
+        for name in base.__dict__.get('__slots__', ())
+        if name != '_fingerprints'
+    )
+
+
+def getstate(node):
+    # Compact pickled state: just values of slots, without their names
+    return tuple(getattr(node, name, None) for name in _slots(node.__class__))
+
+
+def setstate(node, state):
+    for name, value in zip(_slots(node.__class__), state):
+        object.__setattr__(node, name, value)
+
+
 class Sql:
 
+    __slots__ = ()
+
+    __getstate__ = getstate
+    __setstate__ = setstate
+
     def sql(self, **kwargs):
         raise NotImplementedError()
 
+    def fingerprint(self):
+        return fingerprints(self)[0]
+
+    def shape(self):
+        return fingerprints(self)[1]
+
     def __hash__(self):
-        return hash(self.sql(qualified=True))
+        return fingerprints(self)[0]
 
     def __str__(self):
         return self.sql(qualified=True)
@@ -35,6 +250,8 @@ class Sql:
 
 class Comparable:
 
+    __slots__ = ()
+
     def __eq__(self, value):
         return Condition('=', self, value)
 
@@ -53,12 +270,20 @@ class Comparable:
     def __ge__(self, value):
         return Condition('>=', self, value)
 
+    def in_(self, values, strategy=None):
+        return In('IN', self, values, strategy)
+
+    def not_in(self, values, strategy=None):
+        return In('NOT IN', self, values, strategy)
+
     def __hash__(self):
         return super().__hash__()
 
 
 class Binary:
 
+    __slots__ = ()
+
     def __and__(self, value):
         return Operation('&', self, value)
 
@@ -94,6 +319,8 @@ class Binary:
 
 class Numerical:
 
+    __slots__ = ()
+
     def __add__(self, value):
         return Operation('+', self, value)
 
@@ -127,6 +354,8 @@ class Numerical:
 
 class Matchable:
 
+    __slots__ = ()
+
     def like(self, pattern):
         return Operation('LIKE', self, pattern)
 
@@ -136,12 +365,16 @@ class Matchable:
 
 class Aliasable:
 
+    __slots__ = ()
+
     def alias(self, alias):
         return Alias(self, alias)
 
 
 class Field(Comparable, Binary, Numerical, Matchable, Aliasable, Sql):
 
+    __slots__ = ('name', 'parent', '_fingerprints', )
+
     def __init__(self, name, parent=None):
         self.name = name
         self.parent = parent
@@ -163,9 +396,15 @@ class Field(Comparable, Binary, Numerical, Matchable, Aliasable, Sql):
     def sql(self, **kwargs):
         return self.get_name(**kwargs)
 
+    def _fingerprint_parts(self):
+        parent = getattr(self, 'parent', None)
+        return (self.__class__.__name__, self.name), parent is not None and [parent, ] or []
+
 
 class Alias(Field):
 
+    __slots__ = ('target', )
+
     def __init__(self, field, alias):
         super().__init__(name=alias)
         self.target = field
@@ -173,67 +412,161 @@ class Alias(Field):
     def sql(self, **kwargs):
         return f'{get_name(self.target, **kwargs)} AS {self.name}'
 
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, self.name), [self.target, ]
+
 
 class Expression(Sql):
 
+    __slots__ = ('operator', 'left', 'right', '_fingerprints', )
+
     def __init__(self, operator, left, right):
         self.operator = operator
         self.left = left
         self.right = right
 
     def sql(self, parenthesis=False, **kwargs):
-        return f'{parenthesis and "(" or ""}' \
-               f'{to_sql(self.left, parenthesis=True, **kwargs)}' \
-               f' {self.operator} ' \
-               f'{to_sql(self.right, parenthesis=True, **kwargs)}' \
-               f'{parenthesis and ")" or ""}'
+        return render(self, parenthesis=parenthesis, **kwargs)
+
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, self.operator), [self.left, self.right]
 
     def __repr__(self):
         return f'<{self.__class__.__name__} {self.sql(qualified=True)}>'
 
 
 class Condition(Comparable, Expression):
-    pass
+
+    __slots__ = ()
 
 
 class Operation(Comparable, Binary, Numerical, Aliasable, Expression):
-    pass
+
+    __slots__ = ()
+
+
+class In(Condition):
+
+    __slots__ = ('strategy', )
+
+    # Each value is rendered as separate literal (or placeholder)
+    VALUES = 'values'
+    # All values are passed as single JSON array, and unpacked with json_each()
+    JSON = 'json'
+
+    # Above this number of values JSON strategy is used
+    VALUES_LIMIT = 100
+
+    # Values that can be passed in JSON array, dates are passed as text like
+    # sqlite3 adapters do. Blobs and expressions need VALUES strategy
+    JSON_TYPES = (str, int, float, type(None), datetime.date, )
+
+    def __init__(self, operator, left, values, strategy=None):
+        if not hasattr(values, 'sql'):
+            values = tuple(values)
+            json_values = all(isinstance(value, self.JSON_TYPES) for value in values)
+            if strategy == self.JSON and not json_values:
+                raise ValueError('Only numbers, text and dates can be passed with JSON strategy')
+            strategy = strategy or (len(values) > self.VALUES_LIMIT and json_values and self.JSON or self.VALUES)
+        super().__init__(operator, left, values)
+        self.strategy = strategy
+
+    @staticmethod
+    def _json_value(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat(' ')
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    def _values_sql(self, literals=None, **kwargs):
+        if hasattr(self.right, 'sql'):
+            # Subquery
+            return to_sql(self.right, literals=literals, **kwargs)
+        if self.strategy == self.JSON:
+            values = json.dumps(self.right, default=self._json_value)
+            if literals is not None:
+                values = literals(values)
+            else:
+                values = "'{}'".format(values.replace("'", "''"))
+            return f'SELECT value FROM json_each({values})'
+        return ', '.join(
+            f'{to_value_sql(value, literals=literals, **kwargs)}'
+            for value in self.right
+        )
+
+    def sql(self, parenthesis=False, **kwargs):
+        return f'{parenthesis and "(" or ""}' \
+               f'{to_value_sql(self.left, parenthesis=True, **kwargs)}' \
+               f' {self.operator} ' \
+               f'({self._values_sql(**kwargs)})' \
+               f'{parenthesis and ")" or ""}'
+
+    def _fingerprint_parts(self):
+        data = (self.__class__.__name__, self.operator, self.strategy)
+        if self.strategy == self.VALUES:
+            # Each value has its own placeholder
+            data += (len(self.right), )
+        if hasattr(self.right, 'sql'):
+            return data, [self.left, self.right]
+        if self.strategy == self.JSON:
+            # Single parameter, whatever the number of values
+            return data, [self.left, json.dumps(self.right, default=self._json_value)]
+        return data, [self.left, *self.right]
+
+
+class RowValue(Comparable, Sql):
+
+    __slots__ = ('values', '_fingerprints', )
+
+    def __init__(self, *values):
+        self.values = FieldsList(values)
+
+    def sql(self, **kwargs):
+        kwargs.pop('parenthesis', None)
+        return f'({render(self.values, value=True, **kwargs)})'
+
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, ), list(self.values)
 
 
 class FieldsList(list):
 
+    __slots__ = ()
+
     def sql(self, **kwargs):
-        return ', '.join(
-            f'{to_sql(field, **kwargs)}' for field in self
-        )
+        return render(self, **kwargs)
 
 
 class ConditionsList(list):
 
+    __slots__ = ()
+
     OPERATOR = ''
 
     def sql(self, parenthesis=False, **kwargs):
-        conditions = [
-            to_sql(condition, parenthessis=True, **kwargs)
-            for condition in self
-        ]
-        return f'{parenthesis and "(" or ""}' \
-               f'{f" {self.OPERATOR} ".join(conditions)}' \
-               f'{parenthesis and ")" or ""}'
+        # Nested lists are always wrapped in parenthesis
+        return render(self, parenthesis=parenthesis, **kwargs)
 
 
 class And(ConditionsList):
 
+    __slots__ = ()
+
     OPERATOR = 'AND'
 
 
 class Or(ConditionsList):
 
+    __slots__ = ()
+
     OPERATOR = 'OR'
 
 
 class Aggregate(Field):
 
+    __slots__ = ('distinct', 'columns', )
+
     ALL_COLUMNS = ['*', ]
 
     def __init__(self, name, *columns, distinct=False):
@@ -249,3 +582,6 @@ class Aggregate(Field):
                f'{self.distinct and "DISTINCT " or ""}' \
                f'{self.columns.sql(**kwargs)})'
 
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, self.name, self.distinct), [self.columns, ]
+
@@ -1,61 +1,452 @@
+import contextlib
+import hashlib
 import logging
+import os
 import sqlite3
+import threading
+import time
+
+from . import formats
+from .cache import table_names
+from .converters import CONVERTERS
+from .explain import QueryPlan, suggest_indexes
+from .instrumentation import CountingCursor
+from .parallel import parallel_select
+from .pool import ConnectionPool, Result
+from .utils import chunked
 
 
 log = logging.getLogger('sql.db')
 
 
+class ChunkResult:
+
+    def __init__(self, rows, rowcount, elapsed):
+        self.rows = rows
+        self.rowcount = rowcount
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} rows={self.rows} rowcount={self.rowcount} elapsed={self.elapsed:.6f}>'
+
+
+class BatchResult:
+
+    def __init__(self):
+        self.chunks = []
+
+    @property
+    def rows(self):
+        return sum(chunk.rows for chunk in self.chunks)
+
+    @property
+    def rowcount(self):
+        return sum(chunk.rowcount for chunk in self.chunks)
+
+    @property
+    def elapsed(self):
+        return sum(chunk.elapsed for chunk in self.chunks)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} chunks={len(self.chunks)} rows={self.rows} rowcount={self.rowcount}>'
+
+
 class DB:
 
-    def __init__(self, fn, *tables, indexes=None):
+    CHUNK_SIZE = 1000
+    BATCH_SIZE = 1000
+    PARAMSTYLE = sqlite3.paramstyle
+
+    def __init__(self, fn, *tables, indexes=None, readers=None, timeout=5.0, parameterize=False,
+                 instrumentation=None, row_format=formats.ROW, converters=None, detect_types=0,
+                 cache=None):
         self.fn = fn
+        self.instrumentation = instrumentation
+        # Opt-in: render literal values as parameters (see Query.sql_with_params()),
+        # unless params are passed explicitly. Off by default, since strings are
+        # SQL everywhere else and would be bound as values
+        self.parameterize = parameterize
+        if row_format not in formats.ROW_FORMATS:
+            raise ValueError(f'Unknown row format: {row_format}')
+        self.row_format = row_format
+        # Values are converted by data types of selected columns, instead of
+        # sqlite3 converters (detect_types)
+        self.converters = converters or CONVERTERS
+        self.detect_types = detect_types
+        # Optional ResultCache for read only queries
+        self.cache = cache
+        # Tables written to since last commit
+        self._dirty = set()
         self._connection = None
+        # Set when writer connection is open and schema is created
+        self._opened = False
         self._tables = {
             table.name: table
             for table in tables
         }
         self._indexes = indexes or []
+        self._schema_fingerprint = None
+        # Pool mode: N WAL readers for Select queries and single writer for everything else
+        self.readers = readers
+        self.timeout = timeout
+        # Pool opens connections on demand, so it's created right away, not
+        # lazily by racing threads
+        self._readers = readers and ConnectionPool(self._connect_reader, readers, timeout) or None
+        self._writer_lock = threading.RLock()
+        # Number of open transaction() / savepoint() blocks, guarded by writer lock
+        self._depth = 0
+        self._transaction_thread = None
+
+    def _connect(self, **kwargs):
+        connection = sqlite3.connect(
+            self.fn,
+            detect_types=self.detect_types,
+            timeout=self.timeout,
+            **kwargs,
+        )
+        # Rows of queries executed by DB are formatted per cursor
+        connection.row_factory = sqlite3.Row
+        if self.instrumentation and self.instrumentation.trace:
+            connection.set_trace_callback(self.instrumentation.trace_callback)
+        return connection
+
+    def _connect_reader(self):
+        # Make sure schema is created (and WAL enabled) by writer first, waiting
+        # for other thread creating it. Writer lock is not needed afterwards
+        if not self._opened:
+            with self._writer_lock:
+                self.connection
+        connection = self._connect(check_same_thread=False)
+        connection.execute('PRAGMA query_only=ON')
+        return connection
 
     @property
     def connection(self):
         if self._connection is None:
-            self._connection = sqlite3.connect(
-                self.fn,
-                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-            )
-            self._connection.row_factory = sqlite3.Row
-            self._create_tables()
-            self._create_indexes()
+            with self._writer_lock:
+                if self._connection is None:
+                    if self.readers:
+                        self._connection = self._connect(check_same_thread=False)
+                        self._connection.execute('PRAGMA journal_mode=WAL')
+                    else:
+                        self._connection = self._connect()
+                    self._create_schema()
+                    self._opened = True
         return self._connection
 
-    def execute_query(self, query, *params):
-        # print(query)
-        return self.connection.execute(
-            query.sql(),
-            params,
+    @contextlib.contextmanager
+    def reader(self):
+        if not self.readers:
+            yield self.connection
+            return
+        with self._readers.connection() as connection:
+            yield connection
+
+    @contextlib.contextmanager
+    def writer(self):
+        if not self._writer_lock.acquire(timeout=self.timeout):
+            raise TimeoutError('Writer connection not available')
+        try:
+            yield self.connection
+        finally:
+            self._writer_lock.release()
+
+    @contextlib.contextmanager
+    def transaction(self, mode=None):
+        # Everything executed inside the block is committed once at the end,
+        # nested blocks become savepoints
+        with self.writer() as connection:
+            if self._depth:
+                with self.savepoint() as connection:
+                    yield connection
+                return
+            if connection.in_transaction:
+                # Don't fold pending implicit transaction into this one
+                connection.commit()
+                self._ended()
+            connection.execute(mode and f'BEGIN {mode}' or 'BEGIN')
+            self._depth += 1
+            self._transaction_thread = threading.get_ident()
+            try:
+                yield connection
+            except:
+                connection.rollback()
+                raise
+            else:
+                connection.commit()
+            finally:
+                self._depth -= 1
+                self._ended()
+
+    @contextlib.contextmanager
+    def savepoint(self, name=None):
+        with self.writer() as connection:
+            name = name or f'savepoint_{self._depth}'
+            if not connection.in_transaction:
+                # Outside of transaction SAVEPOINT starts one, and its RELEASE
+                # commits it, so keep it open until commit() or rollback()
+                connection.execute('BEGIN')
+            connection.execute(f'SAVEPOINT {name}')
+            self._depth += 1
+            self._transaction_thread = threading.get_ident()
+            try:
+                yield connection
+            except:
+                connection.execute(f'ROLLBACK TO {name}')
+                self._ended(clear=False)
+                raise
+            finally:
+                self._depth -= 1
+                connection.execute(f'RELEASE {name}')
+
+    def checkout(self, query):
+        if self._depth and self._transaction_thread == threading.get_ident():
+            # Reads inside transaction block have to see its uncommitted writes
+            return self.writer()
+        if getattr(query, 'READ_ONLY', False):
+            return self.reader()
+        return self.writer()
+
+    def render(self, query, params=()):
+        if not params and self.parameterize and hasattr(query, 'sql_with_params'):
+            return query.sql_with_params(self.PARAMSTYLE)
+        return query.sql(), params
+
+    def _execute(self, connection, query, sql, params, many=False, row_format=None):
+        execute = many and connection.executemany or connection.execute
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            cursor = execute(sql, params)
+        else:
+            instrumentation.before(query, sql, params)
+            start = time.perf_counter()
+            cursor = execute(sql, params)
+            instrumentation.after(query, sql, params, time.perf_counter()-start)
+            if cursor.rowcount > 0:
+                instrumentation.rows(query, sql, cursor.rowcount)
+        if not many:
+            formats.set_row_factory(cursor, row_format or self.row_format, self.converters.plan(query))
+        return cursor
+
+    def _result(self, connection, query, sql, cursor, row_format=None, fetch=False):
+        if (row_format or self.row_format) == formats.COLUMNAR:
+            try:
+                columns = formats.fetch_columnar(cursor, self.BATCH_SIZE)
+            finally:
+                cursor.close()
+            if self.instrumentation:
+                self.instrumentation.rows(query, sql, formats.count(columns))
+            return columns
+        if connection is self.connection and not fetch:
+            if self.instrumentation:
+                return CountingCursor(cursor, self.instrumentation, query, sql)
+            return cursor
+        result = Result(cursor)
+        if self.instrumentation:
+            self.instrumentation.rows(query, sql, len(result.rows))
+        return result
+
+    def execute_query(self, query, *params, row_format=None):
+        sql, params = self.render(query, params)
+        return self._query(query, sql, params, row_format)
+
+    def execute_compiled(self, compiled, *args, row_format=None, **values):
+        return self._query(compiled, compiled.text, compiled.bind(*args, **values), row_format)
+
+    def _query(self, query, sql, params, row_format=None):
+        read_only = getattr(query, 'READ_ONLY', False)
+        if self.cache is None or not read_only:
+            with self.checkout(query) as connection:
+                cursor = self._execute(connection, query, sql, params, row_format=row_format)
+                result = self._result(connection, query, sql, cursor, row_format)
+            if self.cache is not None:
+                self._written(query)
+            return result
+        return self._cached(query, sql, params, row_format)
+
+    def _cached(self, query, sql, params, row_format=None):
+        row_format = row_format or self.row_format
+        cache = self.cache
+        key = cache.key(sql, params, row_format)
+        result = None
+        if key is not None:
+            result = cache.get(key)
+        if result is None:
+            generation = cache.generation
+            with self.checkout(query) as connection:
+                cursor = self._execute(connection, query, sql, params, row_format=row_format)
+                result = self._result(connection, query, sql, cursor, row_format, fetch=True)
+            if key is not None:
+                cache.put(key, table_names(query), result, generation)
+        if row_format == formats.COLUMNAR:
+            return dict(result)
+        return result.copy()
+
+    def _written(self, query):
+        # Evict cached results of written tables now, and once again on commit
+        # or rollback, as they could be read (from pool) before
+        tables = table_names(query)
+        self.cache.invalidate(tables)
+        self._dirty.update(tables)
+
+    def _ended(self, clear=True):
+        # Transaction (or savepoint) was committed or rolled back
+        if self.cache is not None and self._dirty:
+            self.cache.invalidate(self._dirty)
+            if clear:
+                self._dirty = set()
+
+    def stream(self, query, *params, batch_size=None, callback=None, row_format=None):
+        # With columnar row format yields dict of columns for each batch
+        row_format = row_format or self.row_format
+        with self.checkout(query) as connection:
+            sql, params = self.render(query, params)
+            cursor = self._execute(connection, query, sql, params, row_format=row_format)
+            rows = 0
+            try:
+                if row_format == formats.COLUMNAR:
+                    for columns in formats.iter_columnar(cursor, batch_size or self.BATCH_SIZE):
+                        rows += formats.count(columns)
+                        if callback:
+                            callback(columns)
+                        yield columns
+                    return
+                while True:
+                    batch = cursor.fetchmany(batch_size or self.BATCH_SIZE)
+                    if not batch:
+                        return
+                    rows += len(batch)
+                    if callback:
+                        callback(batch)
+                    yield from batch
+            finally:
+                # Also executed when generator is closed (or garbage collected) before exhausted
+                cursor.close()
+                if self.instrumentation:
+                    self.instrumentation.rows(query, sql, rows)
+
+    def parallel_select(self, query, *params, workers=None, ordered=False, row_format=None, batch_size=None):
+        # Splits query.table into rowid ranges, each one selected in separate process
+        return parallel_select(
+            self, query, params, workers or os.cpu_count(),
+            ordered=ordered, row_format=row_format, batch_size=batch_size,
         )
 
+    def explain(self, query, *params):
+        with self.checkout(query) as connection:
+            sql, params = self.render(query, params)
+            rows = connection.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        plan = QueryPlan(sql, [tuple(row) for row in rows])
+        plan.suggestions = suggest_indexes(query, plan, self._tables, self._indexes)
+        return plan
+
+    def execute_many(self, query, rows, chunk_size=None, commit=True):
+        with self.writer():
+            try:
+                return self._execute_many(query, rows, chunk_size, commit)
+            finally:
+                if self.cache is not None:
+                    self._written(query)
+
+    def _execute_many(self, query, rows, chunk_size=None, commit=True):
+        # Render once, then feed rows to executemany() chunk by chunk. Each chunk
+        # is either committed, or wrapped in a savepoint leaving transaction open
+        sql = query.sql()
+        bind = getattr(query, 'bind', None)
+        if bind is not None:
+            rows = (
+                bind(**row) if isinstance(row, dict) else row
+                for row in rows
+            )
+        result = BatchResult()
+        for chunk in chunked(rows, chunk_size or self.CHUNK_SIZE):
+            start = time.perf_counter()
+            if commit:
+                with self.transaction() as connection:
+                    cursor = self._execute(connection, query, sql, chunk, many=True)
+            else:
+                with self.savepoint('execute_many') as connection:
+                    cursor = self._execute(connection, query, sql, chunk, many=True)
+            result.chunks.append(
+                ChunkResult(len(chunk), cursor.rowcount, time.perf_counter()-start)
+            )
+        return result
+
     def commit(self):
-        self.connection.commit()
+        with self.writer() as connection:
+            if self._depth:
+                # Committed by the outermost transaction() block
+                return
+            connection.commit()
+            self._ended()
 
     def rollback(self):
-        self.connection.rollback()
+        with self.writer() as connection:
+            if self._depth:
+                raise sqlite3.OperationalError('Cannot rollback inside transaction block, raise instead')
+            connection.rollback()
+            self._ended()
 
     def close(self):
+        if self._readers:
+            self._readers.close()
         if self._connection:
             self.connection.close()
 
+    def schema_fingerprint(self):
+        # Stored as PRAGMA user_version, which is signed 32-bit integer,
+        # and 0 is reserved for database without schema
+        if self._schema_fingerprint is None:
+            definitions = [
+                query.sql()
+                for query in [table.create() for table in self._tables.values()] + \
+                             [index.create() for index in self._indexes]
+            ]
+            digest = hashlib.blake2b('\n'.join(definitions).encode(), digest_size=4).digest()
+            self._schema_fingerprint = int.from_bytes(digest, 'big', signed=True) or 1
+        return self._schema_fingerprint
+
+    def _schema_version(self):
+        return self._connection.execute('PRAGMA user_version').fetchone()[0]
+
+    def _create_schema(self):
+        fingerprint = self.schema_fingerprint()
+        if self._schema_version() == fingerprint:
+            return
+        with self.transaction(mode='IMMEDIATE') as connection:
+            # Check again, schema might be created by other process in the meantime
+            if self._schema_version() == fingerprint:
+                return
+            log.info('Updating schema of %s to %s', self.fn, fingerprint)
+            self._create_tables()
+            self._create_indexes()
+            connection.execute(f'PRAGMA user_version={fingerprint}')
+
     def _create_tables(self):
+        # Create missing tables and add missing columns. Changed or removed
+        # columns are not migrated
+        tables = {
+            row[0]
+            for row in self._connection.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        }
         for table in self._tables.values():
-            query = table.create(if_not_exists=True)
-            # print(query)
-            self.execute_query(query)
-            self.commit()
+            if table.name not in tables:
+                self.execute_query(table.create(if_not_exists=True))
+                continue
+            columns = {
+                row[1]
+                for row in self._connection.execute(f'PRAGMA table_info({table.name})')
+            }
+            for column in table.columns:
+                if column.name not in columns:
+                    self.execute_query(table.add_column(column))
 
     def _create_indexes(self):
+        indexes = {
+            row[0]
+            for row in self._connection.execute("SELECT name FROM sqlite_master WHERE type='index'")
+        }
         for index in self._indexes:
-            query = index.create(if_not_exists=True)
-            # print(query)
-            self.execute_query(query)
-            self.commit()
+            if index.name not in indexes:
+                self.execute_query(index.create(if_not_exists=True))
 
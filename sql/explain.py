@@ -0,0 +1,216 @@
+import logging
+
+from .core import get_name, Condition, In, And
+from .tables import Column
+
+
+log = logging.getLogger('sql.explain')
+
+
+class PlanNode:
+
+    def __init__(self, id, parent, detail, subqueries=None):
+        self.id = id
+        self.parent = parent
+        self.detail = detail
+        self.children = []
+        # Names of subqueries and CTEs materialized (or run as co-routines) in the plan
+        self.subqueries = subqueries if subqueries is not None else set()
+
+    @property
+    def is_scan(self):
+        # Full table scan, "SCAN t USING (COVERING) INDEX i" walks an index instead.
+        # Constant rows, virtual tables and subqueries are not table scans
+        if not self.detail.startswith('SCAN ') or ' USING ' in self.detail:
+            return False
+        if ' VIRTUAL TABLE ' in self.detail:
+            return False
+        name = self.table_name
+        return name is not None and name not in self.subqueries
+
+    @property
+    def is_temp_btree(self):
+        return self.detail.startswith('USE TEMP B-TREE')
+
+    @property
+    def is_automatic_index(self):
+        return 'AUTOMATIC' in self.detail
+
+    @property
+    def subquery_name(self):
+        # "MATERIALIZE s", "CO-ROUTINE s" (or with number before SQLite 3.36)
+        if self.detail.startswith(('MATERIALIZE ', 'CO-ROUTINE ')):
+            return self.detail.split()[1]
+        return None
+
+    @property
+    def table_name(self):
+        # "SCAN t", "SEARCH t USING ...", or "SCAN TABLE t", "SEARCH TABLE t USING ..."
+        # before SQLite 3.36. None for "SCAN CONSTANT ROW" and "SCAN SUBQUERY 1"
+        words = self.detail.split()
+        if words[0] not in {'SCAN', 'SEARCH'} or len(words) < 2:
+            return None
+        if words[1] in {'CONSTANT', 'SUBQUERY'}:
+            return None
+        if words[1] == 'TABLE' and len(words) > 2:
+            return words[2]
+        return words[1]
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.detail}>'
+
+
+class QueryPlan:
+
+    def __init__(self, sql, rows, suggestions=None):
+        self.sql = sql
+        self.nodes = []
+        self.roots = []
+        by_id = {}
+        subqueries = set()
+        for id, parent, notused, detail in rows:
+            node = PlanNode(id, parent, detail, subqueries)
+            if node.subquery_name is not None:
+                subqueries.add(node.subquery_name)
+            self.nodes.append(node)
+            by_id[id] = node
+            if parent in by_id:
+                by_id[parent].children.append(node)
+            else:
+                self.roots.append(node)
+        self.suggestions = suggestions or []
+
+    @property
+    def scans(self):
+        return [node for node in self.nodes if node.is_scan]
+
+    @property
+    def temp_btrees(self):
+        return [node for node in self.nodes if node.is_temp_btree]
+
+    @property
+    def automatic_indexes(self):
+        return [node for node in self.nodes if node.is_automatic_index]
+
+    @property
+    def issues(self):
+        return [
+            node.detail for node in self.nodes
+            if node.is_scan or node.is_temp_btree or node.is_automatic_index
+        ]
+
+    def __str__(self):
+        lines = []
+        stack = [(node, 0) for node in reversed(self.roots)]
+        while stack:
+            node, depth = stack.pop()
+            lines.append(f'{"    " * depth}{node.detail}')
+            stack.extend((child, depth+1) for child in reversed(node.children))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} nodes={len(self.nodes)} issues={len(self.issues)}>'
+
+
+EQUALITY_OPERATORS = {'=', '==', 'IS', 'IN', }
+RANGE_OPERATORS = {'<', '<=', '>', '>=', }
+
+
+def filtered_columns(query):
+    # Returns lists of columns used in equality and range conditions
+    equality = []
+    ranges = []
+    conditions = [
+        *getattr(query, 'rows_conditions', []),
+        *(condition for join in getattr(query, 'joins', []) for condition in join.on_conditions),
+    ]
+    while conditions:
+        condition = conditions.pop(0)
+        if isinstance(condition, And):
+            conditions.extend(condition)
+            continue
+        if not isinstance(condition, Condition):
+            # Or (or raw SQL) can't be covered with single index
+            continue
+        if condition.operator in EQUALITY_OPERATORS:
+            columns = equality
+        elif condition.operator in RANGE_OPERATORS:
+            columns = ranges
+        else:
+            continue
+        sides = [condition.left, ]
+        if not isinstance(condition, In):
+            sides.append(condition.right)
+        for side in sides:
+            if isinstance(side, Column):
+                columns.append(side)
+    return equality, ranges
+
+
+def ordered_columns(query):
+    # GROUP BY columns, or ORDER BY columns if there's no grouping
+    columns = list(getattr(query, 'group_by_columns', []))
+    if not columns:
+        columns = [
+            column
+            for ordering in getattr(query, 'orderings', [])
+            for column in ordering.columns
+        ]
+    return [column for column in columns if isinstance(column, Column)]
+
+
+def index_columns(table, indexes):
+    # Yields (columns, unique) of existing indexes of the table
+    for index in indexes:
+        if get_name(index.table) == table.name:
+            yield [get_name(column) for column in index.columns], index.unique
+    for constraint in table.constraints:
+        yield [get_name(column) for column in constraint.columns], True
+    for column in table.columns:
+        constraints = (column.constraints or '').upper()
+        if 'PRIMARY KEY' in constraints or 'UNIQUE' in constraints:
+            yield [column.name, ], True
+
+
+def suggest_indexes(query, plan, tables, indexes):
+    # Equality columns first, then first range column, or columns used for ordering
+    flagged = {node.table_name for node in plan.scans}
+    if plan.temp_btrees:
+        flagged.add(get_name(getattr(query.table, 'target', query.table)))
+    equality, ranges = filtered_columns(query)
+    ordered = ordered_columns(query)
+    aliases = query._kwargs().get('aliases', {})
+    suggestions = []
+    for name, table in tables.items():
+        if name not in flagged and aliases.get(name) not in flagged:
+            continue
+        columns = []
+        for column in equality:
+            if column.table is table and column.name not in columns:
+                columns.append(column.name)
+        table_ordered = [column.name for column in ordered if column.table is table]
+        if table_ordered and len(table_ordered) == len(ordered):
+            columns.extend(name for name in table_ordered if name not in columns)
+        else:
+            for column in ranges:
+                if column.table is table and column.name not in columns:
+                    columns.append(column.name)
+                    break
+        if not columns:
+            continue
+        equality_columns = [column.name for column in equality if column.table is table]
+        if any(
+            # Existing index already starts with suggested columns, or
+            # equality on unique columns matches at most one row anyway
+            existing[:len(columns)] == columns or
+            (unique and set(existing) <= set(equality_columns))
+            for existing, unique in index_columns(table, indexes)
+        ):
+            continue
+        suggestions.append(
+            table.index(
+                f'{table.name}_{"_".join(columns)}_idx',
+                *[getattr(table.columns, column) for column in columns]
+            )
+        )
+    return suggestions
@@ -0,0 +1,189 @@
+import array
+import collections
+import dataclasses
+import functools
+import keyword
+import logging
+import sqlite3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+log = logging.getLogger('sql.formats')
+
+
+ROW = 'row'
+TUPLE = 'tuple'
+NAMEDTUPLE = 'namedtuple'
+DATACLASS = 'dataclass'
+# Dict of column name -> array.array (or numpy.ndarray), instead of rows
+COLUMNAR = 'columnar'
+
+ROW_FORMATS = {ROW, TUPLE, NAMEDTUPLE, DATACLASS, COLUMNAR, }
+
+
+def column_names(description):
+    return tuple(column[0] for column in description or ())
+
+
+def unique_names(names):
+    # Joins might return the same name several times: id, id_1, id_2, ...
+    seen = set(names)
+    if len(seen) == len(names):
+        return list(names)
+    unique = []
+    used = set()
+    for name in names:
+        if name in used:
+            i = 1
+            while f'{name}_{i}' in used or f'{name}_{i}' in seen:
+                i += 1
+            name = f'{name}_{i}'
+        used.add(name)
+        unique.append(name)
+    return unique
+
+
+def identifiers(names):
+    # Column names like "COUNT(*)" are not valid attribute names
+    return unique_names([
+        name if name.isidentifier() and not keyword.iskeyword(name) and not name.startswith('_') else f'column_{i}'
+        for i, name in enumerate(names)
+    ])
+
+
+@functools.lru_cache(maxsize=256)
+def row_factory(row_format, names):
+    # Row classes are created once per list of columns
+    if row_format == ROW:
+        return sqlite3.Row
+    if row_format in {TUPLE, COLUMNAR}:
+        return None
+    if row_format == NAMEDTUPLE:
+        cls = collections.namedtuple('Row', identifiers(names))
+        new = tuple.__new__
+        return lambda cursor, row: new(cls, row)
+    if row_format == DATACLASS:
+        cls = dataclasses.make_dataclass('Row', identifiers(names), frozen=True)
+        return lambda cursor, row: cls(*row)
+    raise ValueError(f'Unknown row format: {row_format}')
+
+
+def converting(factory, conversions):
+    # Wraps row factory, so values are converted before row is created
+    def convert(cursor, row):
+        row = list(row)
+        for position, converter in conversions:
+            value = row[position]
+            if value is not None:
+                row[position] = converter(value)
+        row = tuple(row)
+        if factory is None:
+            return row
+        return factory(cursor, row)
+    return convert
+
+
+def detached_factory(row_format, names, conversions=None):
+    # Factory for rows fetched elsewhere (other processes, or shards), called
+    # without cursor, so namedtuples are used instead of sqlite3.Row
+    if row_format == ROW:
+        row_format = NAMEDTUPLE
+    factory = row_factory(row_format, names)
+    if conversions:
+        factory = converting(factory, conversions)
+    return factory
+
+
+def set_row_factory(cursor, row_format, conversions=None):
+    # Cursor's row_factory is used when fetching, so it can be set after execute()
+    # when cursor.description is known
+    if cursor.description is not None:
+        factory = row_factory(row_format, column_names(cursor.description))
+        if conversions:
+            factory = converting(factory, conversions)
+        cursor.row_factory = factory
+    return cursor
+
+
+class Column:
+
+    # Values are collected in array.array while all of them are int or float,
+    # and in list otherwise (text, blobs, NULLs)
+
+    TYPECODES = {
+        int: 'q',
+        float: 'd',
+    }
+
+    def __init__(self):
+        self.values = None
+
+    def extend(self, values):
+        if self.values is None:
+            typecode = self.TYPECODES.get(type(values[0]))
+            self.values = array.array(typecode) if typecode else []
+        if isinstance(self.values, array.array):
+            length = len(self.values)
+            try:
+                self.values.extend(values)
+                return
+            except (TypeError, OverflowError):
+                # Part of values might be already appended
+                self.values = self.values[:length].tolist()
+        self.values.extend(values)
+
+    def to_array(self):
+        values = self.values
+        if values is None:
+            values = []
+        if numpy is None:
+            return values
+        if isinstance(values, array.array):
+            return numpy.frombuffer(values, dtype=values.typecode)
+        return numpy.array(values, dtype=object)
+
+
+def _columns(names, columns):
+    return {
+        name: column.to_array()
+        for name, column in zip(unique_names(names), columns)
+    }
+
+
+def to_columnar(names, rows):
+    columns = [Column() for name in names]
+    for column, values in zip(columns, zip(*rows)):
+        column.extend(values)
+    return _columns(names, columns)
+
+
+def iter_columnar(cursor, batch_size):
+    # Yields dict of columns for each batch of rows fetched from cursor
+    names = column_names(cursor.description)
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        yield to_columnar(names, batch)
+
+
+def fetch_columnar(cursor, batch_size):
+    names = column_names(cursor.description)
+    columns = [Column() for name in names]
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for column, values in zip(columns, zip(*batch)):
+            column.extend(values)
+    return _columns(names, columns)
+
+
+def count(columns):
+    for values in columns.values():
+        return len(values)
+    return 0
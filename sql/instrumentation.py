@@ -0,0 +1,210 @@
+import bisect
+import collections
+import logging
+import threading
+import time
+
+
+log = logging.getLogger('sql.instrumentation')
+
+
+class Histogram:
+
+    # Upper bounds of latency buckets (in seconds), last bucket is unbounded
+    BOUNDS = (
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0,
+    )
+
+    def __init__(self):
+        self.buckets = [0, ] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        # Upper bound of bucket containing given percentile
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= threshold:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.count and self.total / self.count or None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': dict(zip([*map(str, self.BOUNDS), 'inf'], self.buckets)),
+        }
+
+
+class QueryStats:
+
+    def __init__(self, query_type, shape, sql):
+        self.query_type = query_type
+        self.shape = shape
+        self.sql = sql
+        self.latency = Histogram()
+        self.rows = 0
+
+    def snapshot(self):
+        return {
+            'query_type': self.query_type,
+            'shape': self.shape,
+            'sql': self.sql,
+            'rows': self.rows,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class Instrumentation:
+
+    def __init__(self, slow_query_threshold=None, trace=False, max_slow_queries=100, max_traced=1000):
+        # Hooks: before_execute(query, sql, params), after_execute(query, sql, params, elapsed)
+        self.before_execute = []
+        self.after_execute = []
+        self.slow_query_threshold = slow_query_threshold
+        self.trace = trace
+        self.stats = {}
+        self.slow_queries = collections.deque(maxlen=max_slow_queries)
+        self.traced = collections.deque(maxlen=max_traced)
+        self._lock = threading.Lock()
+
+    def _stats(self, query, sql):
+        query = getattr(query, 'query', query)
+        shape = hasattr(query, 'shape') and f'{query.shape():016x}' or sql
+        key = (query.__class__.__name__, shape)
+        stats = self.stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self.stats.setdefault(key, QueryStats(*key, sql))
+        return stats
+
+    def before(self, query, sql, params):
+        for hook in self.before_execute:
+            hook(query, sql, params)
+
+    def after(self, query, sql, params, elapsed):
+        stats = self._stats(query, sql)
+        with self._lock:
+            stats.latency.add(elapsed)
+        if self.slow_query_threshold is not None and elapsed >= self.slow_query_threshold:
+            log.warning('Slow query (%.6fs): %s', elapsed, sql)
+            self.slow_queries.append({
+                'time': time.time(),
+                'elapsed': elapsed,
+                'query_type': stats.query_type,
+                'sql': sql,
+                'params': repr(params),
+            })
+        for hook in self.after_execute:
+            hook(query, sql, params, elapsed)
+
+    def rows(self, query, sql, count):
+        stats = self._stats(query, sql)
+        with self._lock:
+            stats.rows += count
+
+    def trace_callback(self, statement):
+        # Also captures statements issued by sqlite3 module itself (BEGIN, COMMIT, ...)
+        self.traced.append(statement)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'queries': [stats.snapshot() for stats in self.stats.values()],
+                'slow_queries': list(self.slow_queries),
+                'traced': list(self.traced),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.slow_queries.clear()
+            self.traced.clear()
+
+
+class CountingCursor:
+
+    # Cursor returned without fetching its rows (single connection mode), rows
+    # are counted as they are fetched, and reported when cursor is exhausted or closed
+
+    def __init__(self, cursor, instrumentation, query, sql):
+        self._cursor = cursor
+        self._instrumentation = instrumentation
+        self._query = query
+        self._sql = sql
+        self._rows = 0
+
+    def _report(self):
+        rows, self._rows = self._rows, 0
+        if rows:
+            self._instrumentation.rows(self._query, self._sql, rows)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is None:
+            self._report()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self._cursor.arraysize if size is None else size
+        rows = self._cursor.fetchmany(size)
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._report()
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._rows += len(rows)
+        self._report()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            row = next(self._cursor)
+        except StopIteration:
+            self._report()
+            raise
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._report()
+        self._cursor.close()
+
+    def __del__(self):
+        # Rows fetched from cursor which was neither exhausted nor closed
+        self._report()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
@@ -0,0 +1,207 @@
+import copy
+import heapq
+import itertools
+import logging
+
+from . import formats
+
+from .core import get_name, Aggregate, Alias, Field
+from .tables import Columns
+from .utils import Chain
+
+
+log = logging.getLogger('sql.merging')
+
+
+# Order of values of different types in SQLite, NULL is first
+TYPES_ORDER = {int: 1, float: 1, str: 2, bytes: 3, }
+
+
+def _combine_sum(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _combine_min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _combine_max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+class Descending:
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def sort_key(orders):
+    # orders: list of (position, descending, nulls), compares values like SQLite:
+    # NULL < numbers < text < blobs
+    def key(row):
+        values = []
+        for position, descending, nulls in orders:
+            value = row[position]
+            if value is None:
+                # NULLs are first for ASC and last for DESC, unless stated otherwise
+                value = ((descending and nulls == 'FIRST' or not descending and nulls == 'LAST') and 5 or 0, 0)
+            else:
+                value = (TYPES_ORDER.get(type(value), 4), value)
+            values.append(descending and Descending(value) or value)
+        return values
+    return key
+
+
+def unique(rows):
+    seen = set()
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield row
+
+
+class Merge:
+
+    # Merges results of the same Select executed on separate parts of data
+    # (shards, or rowid ranges of the table). Each part executes partial query:
+    # without OFFSET, with enough rows for LIMIT, and with partial aggregates
+    # combined per group afterwards
+
+    COMBINE = {
+        'COUNT': _combine_sum,
+        'SUM': _combine_sum,
+        'TOTAL': _combine_sum,
+        'MIN': _combine_min,
+        'MAX': _combine_max,
+    }
+
+    def __init__(self, query):
+        self.query = query
+        self.limit, self.offset = self._limits(query)
+        self.grouped = bool(query.group_by_columns) or any(
+            isinstance(isinstance(column, Alias) and column.target or column, Aggregate)
+            for column in query.columns
+        )
+        # Fail before any part is executed, when it's known already
+        names = self._selected_names(query)
+        if names is not None:
+            self._orders(names)
+        partial = copy.copy(query)
+        partial.offset_rows = None
+        if self.grouped:
+            self.combiners = self._combiners(query)
+            partial.orderings = Chain()
+            partial.limit_rows = None
+        elif self.limit is not None:
+            # Each part returns enough rows for any of them to make it into the result
+            partial.limit_rows = self.limit + self.offset
+        self.partial = partial
+
+    def _limits(self, query):
+        limit, offset = query.limit_rows, query.offset_rows or 0
+        if not isinstance(offset, int) or limit is not None and not isinstance(limit, int):
+            raise ValueError('Only literal LIMIT and OFFSET are supported when merging results')
+        return limit, offset
+
+    def _combiners(self, query):
+        # Returns list of combine functions for aggregates, None for group by columns
+        if query.groups_conditions:
+            raise ValueError('HAVING can not be applied to partial groups')
+        groups = {hash(column) for column in query.group_by_columns}
+        combiners = []
+        for column in query.columns:
+            target = isinstance(column, Alias) and column.target or column
+            if isinstance(target, Aggregate):
+                combine = self.COMBINE.get(target.name.upper())
+                if combine is None or target.distinct:
+                    raise ValueError(f'Aggregate {target.sql()} can not be combined from partial results')
+                combiners.append(combine)
+            elif not isinstance(target, str) and hash(target) in groups:
+                combiners.append(None)
+            else:
+                raise ValueError(f'Column {get_name(column)} must be aggregated or in GROUP BY')
+        return combiners
+
+    def _selected_names(self, query):
+        # Names of result columns, or None when some of them are known only
+        # from description of executed query (expressions, aggregates)
+        names = []
+        for column in query.columns:
+            if isinstance(column, Alias) or isinstance(column, Field) and not isinstance(column, Aggregate):
+                names.append(column.name)
+            elif isinstance(column, Columns) or isinstance(column, str) and column == '*':
+                for table in query._tables():
+                    columns = getattr(getattr(table, 'target', table), 'columns', None)
+                    if not isinstance(columns, Columns):
+                        return None
+                    names.extend(column.name for column in columns)
+            else:
+                return None
+        return names
+
+    def _orders(self, names):
+        orders = []
+        for ordering in self.query.orderings:
+            columns = list(ordering.columns)
+            for i, column in enumerate(columns):
+                name = get_name(column)
+                if name not in names:
+                    raise ValueError(f'Ordering column {name} must be selected to merge results')
+                # In "ORDER BY a, b DESC" order (and nulls) applies to the last column only
+                if i == len(columns) - 1:
+                    orders.append((names.index(name), ordering.order == 'DESC', ordering.nulls))
+                else:
+                    orders.append((names.index(name), False, None))
+        return orders
+
+    def _combine(self, parts):
+        groups = {}
+        combiners = self.combiners
+        for rows in parts:
+            for row in rows:
+                group = tuple(value for value, combine in zip(row, combiners) if combine is None)
+                combined = groups.get(group)
+                if combined is not None:
+                    row = [
+                        a if combine is None else combine(a, b)
+                        for a, b, combine in zip(combined, row, combiners)
+                    ]
+                groups[group] = row
+        return [tuple(row) for row in groups.values()]
+
+    def rows(self, description, parts):
+        # Lazily yields merged rows (tuples) from iterable of rows of each part,
+        # when there's no ordering parts are consumed in given order
+        orders = self._orders(formats.column_names(description))
+        if self.grouped:
+            rows = self._combine(parts)
+            if orders:
+                rows.sort(key=sort_key(orders))
+        elif orders:
+            rows = heapq.merge(*parts, key=sort_key(orders))
+        else:
+            rows = itertools.chain.from_iterable(parts)
+        if self.query.distinct and not self.grouped:
+            rows = unique(rows)
+        limit, offset = self.limit, self.offset
+        return itertools.islice(rows, offset, None if limit is None else offset + limit)
@@ -0,0 +1,100 @@
+import concurrent.futures
+import itertools
+import logging
+import os
+import pathlib
+import sqlite3
+
+from . import formats
+
+from .core import Field
+from .merging import Merge
+
+
+log = logging.getLogger('sql.parallel')
+
+
+def read_only_uri(fn):
+    return f'{pathlib.Path(os.path.abspath(fn)).as_uri()}?mode=ro'
+
+
+def rowid_range(connection, table):
+    return connection.execute(f'SELECT min(rowid), max(rowid) FROM {table}').fetchone()
+
+
+def partitions(first, last, count):
+    # Splits [first, last] into count ranges of rowids: [start, stop)
+    if first is None:
+        return []
+    size = max(1, -(-(last - first + 1) // count))
+    return [
+        (start, min(start + size, last + 1))
+        for start in range(first, last + 1, size)
+    ]
+
+
+def partition_query(query, start, stop):
+    table = getattr(query.table, 'target', query.table)
+    rowid = Field('rowid', parent=table)
+    return query.where(rowid >= start, rowid < stop)
+
+
+def select_partition(uri, query, params, paramstyle, timeout):
+    # Executed in worker process, with its own read only connection, paramstyle
+    # is None unless literals are rendered as parameters
+    connection = sqlite3.connect(uri, uri=True, timeout=timeout)
+    try:
+        if params or paramstyle is None:
+            sql = query.sql()
+        else:
+            sql, params = query.sql_with_params(paramstyle)
+        cursor = connection.execute(sql, params)
+        return cursor.description, cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def parallel_select(db, query, params, workers, ordered=False, row_format=None, batch_size=None):
+    # Yields rows of the query executed on rowid ranges of query.table in
+    # separate processes. Unordered results are yielded as soon as partition
+    # is done, ordered ones in order of rowids (or query orderings)
+    if db.fn == ':memory:' or str(db.fn).startswith('file:'):
+        raise ValueError('Parallel select requires database file')
+    merge = Merge(query)
+    table = getattr(query.table, 'target', query.table)
+    with db.reader() as connection:
+        first, last = rowid_range(connection, table)
+    ranges = partitions(first, last, workers)
+    if not ranges:
+        return
+    uri = read_only_uri(db.fn)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                select_partition,
+                uri, partition_query(merge.partial, start, stop), params,
+                db.parameterize and db.PARAMSTYLE or None, db.timeout,
+            )
+            for start, stop in ranges
+        ]
+        if ordered or merge.grouped or query.orderings:
+            results = (future.result() for future in futures)
+        else:
+            results = (future.result() for future in concurrent.futures.as_completed(futures))
+        description, rows = next(results)
+        parts = itertools.chain([rows, ], (rows for description, rows in results))
+        rows = merge.rows(description, parts)
+        row_format = row_format or db.row_format
+        names = formats.column_names(description)
+        factory = formats.detached_factory(row_format, names, db.converters.plan(query))
+        if row_format == formats.COLUMNAR:
+            for batch in iter(lambda: list(itertools.islice(rows, batch_size or db.BATCH_SIZE)), []):
+                if factory is not None:
+                    batch = [factory(None, row) for row in batch]
+                yield formats.to_columnar(names, batch)
+            return
+        if factory is None:
+            yield from rows
+            return
+        for row in rows:
+            yield factory(None, row)
@@ -6,8 +6,27 @@ from .core import Field
 log = logging.getLogger('sql.parameters')
 
 
+class Placeholder(Field):
+
+    __slots__ = ('parameter_name', 'paramstyle', 'position', )
+
+    def __init__(self, placeholder, parameter_name, paramstyle, position):
+        super().__init__(name=placeholder)
+        self.parameter_name = parameter_name
+        self.paramstyle = paramstyle
+        self.position = position
+
+    def sql(self, placeholders=None, **kwargs):
+        # Placeholders are collected (in order of appearance) when compiling query
+        if placeholders is not None:
+            placeholders.append(self)
+        return super().sql(**kwargs)
+
+
 class Parameter:
 
+    PARAMSTYLE = None
+
     def __init__(self):
         self.count = 0
         self.names = set()
@@ -16,40 +35,53 @@ class Parameter:
         self.count += 1
         self.names.add(name)
 
+    def placeholder(self, placeholder, name):
+        return Placeholder(placeholder, name, self.PARAMSTYLE, self.count)
+
 
 class QmarkParameter(Parameter):
 
+    PARAMSTYLE = 'qmark'
+
     def __call__(self, name=None):
         super().__call__(name)
-        return Field('?')
+        return self.placeholder('?', name)
 
 
 class NumericParameter(Parameter):
 
+    PARAMSTYLE = 'numeric'
+
     def __call__(self, name):
         super().__call__(name)
-        return Field(f':{self.count}')
+        return self.placeholder(f':{self.count}', name)
 
 
 class NamedParameter(Parameter):
 
+    PARAMSTYLE = 'named'
+
     def __call__(self, name):
         super().__call__(name)
-        return Field(f':{name}')
+        return self.placeholder(f':{name}', name)
 
 
 class FormatParameter(Parameter):
 
+    PARAMSTYLE = 'format'
+
     def __call__(self, name=None):
         super().__call__(name)
-        return Field('%s')
+        return self.placeholder('%s', name)
 
 
 class PyformatParameter(Parameter):
 
+    PARAMSTYLE = 'pyformat'
+
     def __call__(self, name):
         super().__call__(name)
-        return Field(f'%({name})s')
+        return self.placeholder(f'%({name})s', name)
 
 
 PARAMSTYLES = {
@@ -63,3 +95,35 @@ PARAMSTYLES = {
 def get_parameters_builder(paramstyle):
     return PARAMSTYLES.get(paramstyle)
 
+
+class Literals:
+
+    # Collects literal values rendered as placeholders
+
+    NAMED_PARAMSTYLES = {'named', 'pyformat', }
+
+    # Never cache SQL rendered with collector
+    __hash__ = None
+
+    def __init__(self, paramstyle='qmark', prefix='p', start=0, placeholders=None):
+        self.parameter = get_parameters_builder(paramstyle)()
+        # Numeric placeholders of literals follow already used positions
+        self.parameter.count = start
+        self.named = paramstyle in self.NAMED_PARAMSTYLES
+        self.prefix = prefix
+        self.placeholders = placeholders
+        self.names = []
+        self.values = []
+
+    def __call__(self, value):
+        name = f'{self.prefix}{len(self.values)+1}'
+        self.names.append(name)
+        self.values.append(value)
+        return self.parameter(name).sql(placeholders=self.placeholders)
+
+    @property
+    def params(self):
+        if self.named:
+            return dict(zip(self.names, self.values))
+        return tuple(self.values)
+
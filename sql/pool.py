@@ -0,0 +1,124 @@
+import contextlib
+import copy
+import logging
+import queue
+import threading
+
+
+log = logging.getLogger('sql.pool')
+
+
+class Result:
+
+    # Rows fetched from cursor, so the connection can go back to the pool right away
+
+    def __init__(self, cursor):
+        self.description = cursor.description
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self.rows = cursor.fetchall()
+        self._position = 0
+        cursor.close()
+
+    @classmethod
+    def from_rows(cls, rows, description=None, rowcount=-1, lastrowid=None):
+        result = cls.__new__(cls)
+        result.description = description
+        result.rowcount = rowcount
+        result.lastrowid = lastrowid
+        result.rows = rows
+        result._position = 0
+        return result
+
+    def fetchone(self):
+        if self._position >= len(self.rows):
+            return None
+        row = self.rows[self._position]
+        self._position += 1
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self._position:self._position+size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self._position:]
+        self._position = len(self.rows)
+        return rows
+
+    def close(self):
+        self._position = len(self.rows)
+
+    def copy(self):
+        # Shares fetched rows, with own position
+        result = copy.copy(self)
+        result._position = 0
+        return result
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} rows={len(self.rows)}>'
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, size, timeout=None):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        # Number of connections opened, or being opened
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def get(self, timeout=None):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            # Slot is reserved under lock, connection is opened outside of it
+            connect = self._opened < self.size
+            if connect:
+                self._opened += 1
+        if connect:
+            try:
+                connection = self._connect()
+            except:
+                with self._lock:
+                    self._opened -= 1
+                raise
+            with self._lock:
+                self._connections.append(connection)
+            return connection
+        try:
+            return self._idle.get(timeout=timeout or self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f'No connection available in pool (size={self.size})') from None
+
+    def put(self, connection):
+        self._idle.put(connection)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        connection = self.get(timeout)
+        try:
+            yield connection
+        finally:
+            self.put(connection)
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+            self._opened = 0
+        self._idle = queue.LifoQueue()
@@ -1,12 +1,17 @@
+import base64
 import copy
+import datetime
 import functools
 import itertools
+import json
 import logging
 
-from . import enums
+from . import enums, formats
 
-from .core import get_name, to_sql
-from .core import Alias, FieldsList, And
+from .core import get_name, to_sql, to_value_sql, fingerprints, getstate, setstate
+from .core import Alias, FieldsList, And, RowValue
+from .parameters import get_parameters_builder, Literals
+from .utils import chunked, Chain
 
 
 log = logging.getLogger('sql.queries')
@@ -22,9 +27,25 @@ def mutate_query(func):
     return _mutate_query
 
 
+def cache_key(kwargs):
+    key = []
+    for name, value in sorted(kwargs.items()):
+        if isinstance(value, dict):
+            value = tuple(sorted(value.items()))
+        key.append((name, value))
+    key = tuple(key)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
 # TODO: I don't like this name...
 class Ordering:
 
+    __slots__ = ('columns', 'order', 'nulls', '_fingerprints', )
+
     def __init__(self, *columns, order=None, nulls=None):
         self.columns = FieldsList(columns)
         self.order = order
@@ -35,9 +56,18 @@ class Ordering:
                f'{self.order and " "+self.order or ""}' \
                f'{self.nulls and " NULLS "+self.nulls or ""}'
 
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, self.order, self.nulls), [self.columns, ]
+
+    __getstate__ = getstate
+    __setstate__ = setstate
+
 
 class Query:
 
+    CACHES = {'_sql_cache', '_fingerprints', '_conversions', }
+    READ_ONLY = False
+
     def __init__(self, table=None, index=None):
         self.table = table
         self.index = index
@@ -65,35 +95,154 @@ class Query:
         return kwargs
 
     def sql(self, **kwargs):
-        kwargs = self._kwargs(**kwargs)
-        return '\n'.join(itertools.chain(self._sql(**kwargs)))
+        cache = self.__dict__.setdefault('_sql_cache', {})
+        key = cache_key(kwargs)
+        if key is not None and key in cache:
+            return cache[key]
+        sql = '\n'.join(itertools.chain(self._sql(**self._kwargs(**kwargs))))
+        if key is not None:
+            cache[key] = sql
+        return sql
+
+    def sql_with_params(self, paramstyle='qmark', **kwargs):
+        # Literal values are replaced with placeholders, so SQL only depends on query shape
+        cache = self.__dict__.setdefault('_sql_cache', {})
+        key = cache_key(kwargs)
+        if key is not None:
+            key = ('params', paramstyle, key)
+            if key in cache:
+                return cache[key]
+        literals = Literals(paramstyle)
+        sql = self.sql(literals=literals, **kwargs)
+        if key is not None:
+            cache[key] = (sql, literals.params)
+        return sql, literals.params
+
+    def _fingerprint_parts(self):
+        data = [self.__class__.__name__, ]
+        children = []
+        for key, value in sorted(self.__dict__.items()):
+            if key in self.CACHES:
+                continue
+            if value is None or isinstance(value, (str, int, float)):
+                data.append((key, value))
+            else:
+                data.append(key)
+                children.append(value)
+        return tuple(data), children
+
+    def fingerprint(self):
+        return fingerprints(self)[0]
+
+    def shape(self):
+        return fingerprints(self)[1]
+
+    def compile(self, **kwargs):
+        return CompiledQuery(self, **kwargs)
+
+    def __getstate__(self):
+        return {
+            key: value
+            for key, value in self.__dict__.items()
+            if key not in self.CACHES
+        }
 
     def __copy__(self):
+        # Builder state is kept in persistent Chains, so it can be shared with the copy
         newone = type(self).__new__(type(self))
         for key, value in self.__dict__.items():
-            if key in {'table', 'index'}:
-                newone.__dict__[key] = value
-            else:
-                newone.__dict__[key] = copy.copy(value)
+            if key in self.CACHES:
+                continue
+            newone.__dict__[key] = value
         return newone
 
     def __str__(self):
         return self.sql()
 
 
+class CompiledQuery:
+
+    NAMED_PARAMSTYLES = Literals.NAMED_PARAMSTYLES
+
+    def __init__(self, query, **kwargs):
+        placeholders = []
+        self.query = query
+        query.sql(placeholders=placeholders, **kwargs)
+        paramstyles = {placeholder.paramstyle for placeholder in placeholders}
+        if len(paramstyles) > 1:
+            raise ValueError(f'Mixed paramstyles in query: {", ".join(sorted(paramstyles))}')
+        self.paramstyle = paramstyles and paramstyles.pop() or None
+        # Literal values are bound as parameters too, with placeholders of the same
+        # paramstyle, so the text only depends on query shape
+        names = {placeholder.parameter_name for placeholder in placeholders}
+        prefix = 'literal_'
+        while any(isinstance(name, str) and name.startswith(prefix) for name in names):
+            prefix = f'_{prefix}'
+        start = max((placeholder.position for placeholder in placeholders), default=0)
+        placeholders = []
+        literals = Literals(self.paramstyle or 'qmark', prefix=prefix, start=start, placeholders=placeholders)
+        self.text = query.sql(placeholders=placeholders, literals=literals, **kwargs)
+        self.literals = dict(zip(literals.names, literals.values))
+        if self.paramstyle is None and literals.values:
+            self.paramstyle = 'qmark'
+        if self.paramstyle == 'numeric':
+            # :1, :2, ... - each position is bound once, no matter how many times it's used.
+            # SQLite numbers them in order of first appearance, literals are mixed in
+            unique = {}
+            for placeholder in placeholders:
+                unique.setdefault(placeholder.position, placeholder)
+            placeholders = list(unique.values())
+        self.names = [placeholder.parameter_name for placeholder in placeholders]
+        self.positions = [placeholder.position for placeholder in placeholders]
+        self.named = self.paramstyle in self.NAMED_PARAMSTYLES
+
+    @property
+    def READ_ONLY(self):
+        return self.query.READ_ONLY
+
+    def bind(self, *args, **values):
+        literals = self.literals
+        if self.named:
+            return {name: literals[name] if name in literals else values[name] for name in self.names}
+        if args:
+            if self.paramstyle == 'numeric':
+                return tuple(
+                    literals[name] if name in literals else args[position - 1]
+                    for name, position in zip(self.names, self.positions)
+                )
+            if not literals:
+                return args
+            args = iter(args)
+            return tuple(literals[name] if name in literals else next(args) for name in self.names)
+        return tuple(literals[name] if name in literals else values[name] for name in self.names)
+
+    def sql(self, **kwargs):
+        return self.text
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.text!r}>'
+
+
 class Join(Query):
 
     def __init__(self, table, join_type=None):
         super().__init__(table=table)
         self.join_type = join_type
-        self.on_conditions = And()
-        self.using_columns = FieldsList()
+        self.on_conditions = Chain()
+        self.using_columns = Chain()
 
+    @mutate_query
     def on(self, *conditions):
-        self.on_conditions.extend(conditions)
+        self.on_conditions = self.on_conditions.extend(conditions)
+        return self
 
+    @mutate_query
     def using(self, *columns):
-        self.using_columns.extend(columns)
+        self.using_columns = self.using_columns.extend(columns)
+        return self
 
     def _sql(self, **kwargs):
         sql = [
@@ -104,12 +253,12 @@ class Join(Query):
         if self.on_conditions:
             sql.extend([
                 f'ON',
-                f'    {self.on_conditions.sql(**kwargs)}',
+                f'    {And(self.on_conditions).sql(**kwargs)}',
             ])
         if self.using_columns:
             sql.extend([
                 f'USING (',
-                f'    {self.using_columns.sql(**kwargs)}',
+                f'    {FieldsList(self.using_columns).sql(**kwargs)}',
                 f')',
             ])
         yield from sql
@@ -119,7 +268,7 @@ class Joinable:
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.joins = []
+        self.joins = Chain()
 
     def _tables(self):
         yield from super()._tables()
@@ -128,7 +277,7 @@ class Joinable:
 
     @mutate_query
     def join(self, table, join_type=None):
-        self.joins.append(
+        self.joins = self.joins.append(
             Join(table, join_type=join_type)
         )
         return self
@@ -159,12 +308,16 @@ class Joinable:
 
     @mutate_query
     def on(self, *conditions):
-        self.joins[-1].on(*conditions)
+        self.joins = self.joins.replace_last(
+            self.joins.last.on(*conditions)
+        )
         return self
 
     @mutate_query
     def using(self, *columns):
-        self.joins[-1].using(*columns)
+        self.joins = self.joins.replace_last(
+            self.joins.last.using(*columns)
+        )
         return self
 
     def _sql(self, **kwargs):
@@ -177,11 +330,11 @@ class RowsFiltered:
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.rows_conditions = And()
+        self.rows_conditions = Chain()
 
     @mutate_query
     def where(self, *conditions):
-        self.rows_conditions.extend(conditions)
+        self.rows_conditions = self.rows_conditions.extend(conditions)
         return self
 
     def _sql(self, **kwargs):
@@ -190,7 +343,7 @@ class RowsFiltered:
             return
         sql = [
             f'WHERE',
-            f'    {self.rows_conditions.sql(**kwargs)}',
+            f'    {And(self.rows_conditions).sql(**kwargs)}',
         ]
         yield from sql
 
@@ -199,11 +352,11 @@ class Grouped:
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.group_by_columns = FieldsList()
+        self.group_by_columns = Chain()
 
     @mutate_query
     def group_by(self, *columns):
-        self.group_by_columns.extend(columns)
+        self.group_by_columns = self.group_by_columns.extend(columns)
         return self
 
     def _sql(self, **kwargs):
@@ -212,7 +365,7 @@ class Grouped:
             return
         sql = [
             f'GROUP BY',
-            f'    {self.group_by_columns.sql(**kwargs)}',
+            f'    {FieldsList(self.group_by_columns).sql(**kwargs)}',
         ]
         yield from sql
 
@@ -221,11 +374,11 @@ class GroupsFiltered(Grouped):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.groups_conditions = And()
+        self.groups_conditions = Chain()
 
     @mutate_query
     def having(self, *conditions):
-        self.groups_conditions.extend(conditions)
+        self.groups_conditions = self.groups_conditions.extend(conditions)
         return self
 
     def _sql(self, **kwargs):
@@ -234,7 +387,7 @@ class GroupsFiltered(Grouped):
             return
         sql = [
             f'HAVING',
-            f'    {self.groups_conditions.sql(**kwargs)}',
+            f'    {And(self.groups_conditions).sql(**kwargs)}',
         ]
         yield from sql
 
@@ -243,11 +396,11 @@ class Ordered:
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.orderings = []
+        self.orderings = Chain()
 
     @mutate_query
     def order_by(self, *columns, order=None, nulls=None):
-        self.orderings.append(
+        self.orderings = self.orderings.append(
             Ordering(*columns, order=order, nulls=nulls)
         )
         return self
@@ -267,6 +420,128 @@ class Ordered:
         yield from sql
 
 
+LIMITED_KEYS = ('limit_rows', 'offset_rows', )
+
+
+class Limited:
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limit_rows = None
+        self.offset_rows = None
+
+    @mutate_query
+    def limit(self, rows):
+        self.limit_rows = rows
+        return self
+
+    @mutate_query
+    def offset(self, rows):
+        self.offset_rows = rows
+        return self
+
+    def _fingerprint_parts(self):
+        data, children = super()._fingerprint_parts()
+        # LIMIT and OFFSET values are literals, like values of Insert,
+        # so they are in fingerprint but not in shape
+        limits = (self.limit_rows, self.offset_rows)
+        data = tuple(
+            item for item in data
+            if item not in LIMITED_KEYS and not (isinstance(item, tuple) and item[0] in LIMITED_KEYS)
+        ) + LIMITED_KEYS
+        children = [
+            child for child in children
+            if all(child is not value for value in limits)
+        ]
+        children.extend(limits)
+        return data, children
+
+    def _sql(self, **kwargs):
+        yield from super()._sql(**kwargs)
+        if self.limit_rows is None and self.offset_rows is None:
+            return
+        sql = [
+            # OFFSET is not allowed without LIMIT, -1 means no limit
+            f'LIMIT {to_value_sql(self.limit_rows is None and -1 or self.limit_rows, **kwargs)}',
+        ]
+        if self.offset_rows is not None:
+            sql.append(
+                f'OFFSET {to_value_sql(self.offset_rows, **kwargs)}'
+            )
+        yield from sql
+
+
+class Paginator:
+
+    # Keyset pagination: next page starts after key of the last row of previous one
+
+    def __init__(self, query, key_columns, page_size, order=None):
+        self.query = query
+        self.key_columns = list(key_columns)
+        self.page_size = page_size
+        self.order = order
+
+    def page_query(self, after=None):
+        query = self.query
+        if after is not None:
+            keys = RowValue(*self.key_columns)
+            values = RowValue(*after)
+            if self.order == enums.Order.DESC:
+                query = query.where(keys < values)
+            else:
+                query = query.where(keys > values)
+        return query.limit(self.page_size)
+
+    def key(self, row):
+        return tuple(row[get_name(column)] for column in self.key_columns)
+
+    @staticmethod
+    def _encode(value):
+        # Dates and timestamps are tagged, so they are decoded back to the same type
+        if isinstance(value, datetime.datetime):
+            return {'datetime': value.isoformat()}
+        if isinstance(value, datetime.date):
+            return {'date': value.isoformat()}
+        raise ValueError(f'Key value of type {type(value).__name__} can not be encoded in cursor')
+
+    @staticmethod
+    def _decode(value):
+        if 'datetime' in value:
+            return datetime.datetime.fromisoformat(value['datetime'])
+        if 'date' in value:
+            return datetime.date.fromisoformat(value['date'])
+        return value
+
+    def cursor(self, row):
+        # Opaque token with key of the row
+        token = json.dumps(self.key(row), separators=(',', ':'), default=self._encode).encode()
+        return base64.urlsafe_b64encode(token).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        token = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return tuple(json.loads(token, object_hook=self._decode))
+
+    def page(self, db, cursor=None):
+        # Returns rows and cursor of the next page (None for the last page)
+        # Keys are taken from rows by column names
+        rows = db.execute_query(self.page_query(self.decode_cursor(cursor)), row_format=formats.ROW).fetchall()
+        if len(rows) < self.page_size:
+            return rows, None
+        return rows, self.cursor(rows[-1])
+
+    def pages(self, db, cursor=None):
+        after = self.decode_cursor(cursor)
+        while True:
+            rows = db.execute_query(self.page_query(after), row_format=formats.ROW).fetchall()
+            if rows:
+                yield rows
+            if len(rows) < self.page_size:
+                return
+            after = self.key(rows[-1])
+
+
 class CreateTable(Query):
 
     def __init__(self, table, if_not_exists=False):
@@ -378,15 +653,56 @@ class DropIndex(Query):
         yield from super()._sql(**kwargs)
 
 
-class Select(Ordered, GroupsFiltered, RowsFiltered, Joinable, Query):
+class Select(Limited, Ordered, GroupsFiltered, RowsFiltered, Joinable, Query):
 
     ALL_COLUMNS = ['*', ]
+    READ_ONLY = True
 
     def __init__(self, *columns, from_table, distinct=False):
         super().__init__(table=from_table)
         self.distinct = distinct
         self.columns = FieldsList(columns or self.ALL_COLUMNS)
 
+    def iter(self, db, *params, batch_size=None, callback=None, row_format=None):
+        return db.stream(self, *params, batch_size=batch_size, callback=callback, row_format=row_format)
+
+    def exists(self):
+        return Exists(self)
+
+    def first(self, db, *params, row_format=None):
+        return db.execute_query(self.limit(1), *params, row_format=row_format).fetchone()
+
+    def scalar(self, db, *params):
+        row = self.first(db, *params, row_format=formats.TUPLE)
+        if row is None:
+            return None
+        return row[0]
+
+    def paginate(self, key_columns=None, page_size=100, order=None):
+        # Without key_columns, keys are taken from orderings
+        query = self
+        if key_columns is None:
+            # "ORDER BY a, b DESC" orders only by the last column descending
+            key_columns = []
+            orders = set()
+            for ordering in self.orderings:
+                columns = list(ordering.columns)
+                key_columns.extend(columns)
+                orders.update(enums.Order.ASC for column in columns[:-1])
+                orders.add(ordering.order or enums.Order.ASC)
+            if len(orders) > 1:
+                raise ValueError('Keyset pagination requires the same order for all key columns')
+            order = orders and orders.pop() or None
+        else:
+            # Pages follow the order of key columns only, existing orderings are replaced
+            query = copy.copy(query)
+            query.orderings = Chain()
+            for column in key_columns:
+                query = query.order_by(column, order=order)
+        if not key_columns:
+            raise ValueError('Keyset pagination requires key columns')
+        return Paginator(query, key_columns, page_size, order=order)
+
     def _sql(self, **kwargs):
         # kwargs['qualified'] = True
         sql = [
@@ -400,25 +716,110 @@ class Select(Ordered, GroupsFiltered, RowsFiltered, Joinable, Query):
         yield from super()._sql(**kwargs)
 
 
+class Exists(Query):
+
+    READ_ONLY = True
+
+    def __init__(self, select):
+        super().__init__(table=select.table)
+        select = copy.copy(select)
+        select.columns = FieldsList(['1', ])
+        select.orderings = Chain()
+        self.select = select.limit(1)
+
+    def _tables(self):
+        yield from self.select._tables()
+
+    def _sql(self, **kwargs):
+        sql = [
+            f'SELECT EXISTS (',
+        ]
+        for line in self.select._sql(**kwargs):
+            sql.append(f'    {line}')
+        sql.append(')')
+        yield from sql
+        yield from super()._sql(**kwargs)
+
+    def check(self, db, *params):
+        return bool(db.execute_query(self, *params, row_format=formats.TUPLE).fetchone()[0])
+
+
 class Insert(Query):
 
+    # SQLITE_MAX_VARIABLE_NUMBER for SQLite older than 3.32.0
+    MAX_VARIABLES = 999
+
     def __init__(self, column_or_inserts=None, /, *columns, into_table, replace=False):
         super().__init__(table=into_table)
         self.replace = replace
         self.columns = FieldsList()
-        self.values = FieldsList()
+        self.insert_values = Chain()
         if isinstance(column_or_inserts, dict):
             self.columns.extend(column_or_inserts.keys())
-            self.values.extend(column_or_inserts.values())
+            self.insert_values = self.insert_values.append(FieldsList(column_or_inserts.values()))
         elif column_or_inserts:
             self.columns.append(column_or_inserts)
         self.columns.extend(columns)
 
     @mutate_query
     def values(self, *values):
-        self.insert_values = FieldsList(values)
+        self.insert_values = self.insert_values.append(FieldsList(values))
         return self
 
+    def batches(self, rows, paramstyle='qmark', max_variables=None):
+        # Lazily yield (sql, params) multi-row inserts, each one under max_variables
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return
+        rows = itertools.chain([first, ], rows)
+        insert = self
+        if not insert.columns and isinstance(first, dict):
+            insert = copy.copy(insert)
+            insert.columns = FieldsList(first.keys())
+        names = [get_name(column) for column in insert.columns]
+        if isinstance(first, dict):
+            rows = (
+                [values[name] for name in names]
+                for values in ({get_name(key): value for key, value in row.items()} for row in rows)
+            )
+        named = paramstyle in CompiledQuery.NAMED_PARAMSTYLES
+        rows_per_statement = max(1, (max_variables or self.MAX_VARIABLES) // max(1, len(names)))
+        statements = {}
+        for chunk in chunked(rows, rows_per_statement):
+            if len(chunk) not in statements:
+                statements[len(chunk)] = insert._placeholders_sql(len(chunk), names, paramstyle)
+            sql = statements[len(chunk)]
+            if named:
+                params = {
+                    f'{name}_{i}': value
+                    for i, row in enumerate(chunk)
+                    for name, value in zip(names, row)
+                }
+            else:
+                params = tuple(itertools.chain.from_iterable(chunk))
+            yield sql, params
+
+    def _fingerprint_parts(self):
+        data, children = super()._fingerprint_parts()
+        # Values in rows are literals, even strings
+        children = [
+            child for child in children
+            if child is not self.insert_values
+        ]
+        children.extend(itertools.chain.from_iterable(self.insert_values))
+        data += tuple(len(values) for values in self.insert_values)
+        return data, children
+
+    def _placeholders_sql(self, rows_count, names, paramstyle):
+        parameter = get_parameters_builder(paramstyle)()
+        insert = copy.copy(self)
+        insert.insert_values = Chain(
+            FieldsList(parameter(f'{name}_{i}') for name in names)
+            for i in range(rows_count)
+        )
+        return insert.sql()
+
     def _sql(self, **kwargs):
         sql = [
             f'INSERT' \
@@ -431,12 +832,14 @@ class Insert(Query):
                 f'    {self.columns.sql(**kwargs)}',
                 f')',
             ])
-        if self.values:
-            sql.extend([
-                f'VALUES (',
-                f'    {self.values.sql(**kwargs)}',
-                f')',
-            ])
+        if self.insert_values:
+            sql.append(f'VALUES (')
+            for values in self.insert_values:
+                sql.extend([
+                    f'    {values.sql(value=True, **kwargs)}',
+                    f'), (',
+                ])
+            sql[-1] = ')'
         yield from sql
         yield from super()._sql(**kwargs)
 
@@ -445,22 +848,30 @@ class Update(RowsFiltered, Query):
 
     def __init__(self, updates=None, *, table):
         super().__init__(table=table)
-        self.updates = dict(updates or {})
+        self.updates = Chain(dict(updates or {}).items())
 
     @mutate_query
     def set(self, column, value):
-        self.updates[column] = value
+        self.updates = self.updates.append((column, value))
         return self
 
+    def _fingerprint_parts(self):
+        data, children = super()._fingerprint_parts()
+        return data, [
+            dict(child) if child is self.updates else child
+            for child in children
+        ]
+
     def _sql(self, **kwargs):
         sql = [
             f'UPDATE',
             f'    {get_name(self.table, **kwargs)}',
             f'SET',
         ]
-        for column, value in self.updates.items():
+        # Setting the same column again overrides value
+        for column, value in dict(self.updates).items():
             sql.append(
-                f'    {get_name(column, **kwargs)}={value},'
+                f'    {get_name(column, **kwargs)}={to_value_sql(value, **kwargs)},'
             )
         if self.updates:
             sql[-1] = sql[-1].rstrip(',')
@@ -0,0 +1,245 @@
+import concurrent.futures
+import copy
+import logging
+import zlib
+
+from . import formats
+
+from .core import get_name, Condition, In
+from .db import DB, BatchResult
+from .merging import Merge
+from .pool import Result
+from .queries import Select, Insert, Update, Exists
+from .tables import Column
+from .utils import chunked, Chain
+
+
+log = logging.getLogger('sql.sharding')
+
+
+def shard_of(value, shards):
+    # Stable between processes, unlike hash() of str
+    if isinstance(value, int):
+        return value % shards
+    if isinstance(value, str):
+        value = value.encode()
+    if not isinstance(value, bytes):
+        value = repr(value).encode()
+    return zlib.crc32(value) % shards
+
+
+class ShardedDB:
+
+    # Rows of tables with shard key are spread over shards, tables without one
+    # are replicated: written to all shards, and read from the first one
+
+    def __init__(self, fns, *tables, shard_keys, shard_function=None, row_format=formats.TUPLE,
+                 **kwargs):
+        if isinstance(shard_keys, Column):
+            shard_keys = [shard_keys, ]
+        self.shard_keys = {
+            get_name(column.table): column
+            for column in shard_keys
+        }
+        self.shard_function = shard_function or shard_of
+        if row_format not in formats.ROW_FORMATS:
+            raise ValueError(f'Unknown row format: {row_format}')
+        self.row_format = row_format
+        # Same tables (and indexes) in each shard
+        self.shards = [DB(fn, *tables, **kwargs) for fn in fns]
+        # Connections are used by thread that created them
+        self._executors = [
+            concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'sql-shard-{i}')
+            for i in range(len(self.shards))
+        ]
+
+    def _submit(self, shard, func, *args, **kwargs):
+        return self._executors[shard].submit(func, self.shards[shard], *args, **kwargs)
+
+    def _map(self, shards, func, *args, **kwargs):
+        # Run func(db, ...) on each of the shards in parallel
+        futures = [self._submit(shard, func, *args, **kwargs) for shard in shards]
+        return [future.result() for future in futures]
+
+    def shard(self, value):
+        return self.shard_function(value, len(self.shards))
+
+    def _shard_key(self, query):
+        table = getattr(getattr(query, 'query', query), 'table', None)
+        if table is None:
+            return None
+        return self.shard_keys.get(get_name(table))
+
+    def _is_key(self, column, key):
+        return isinstance(column, Column) and column.name == key.name and column.table is key.table
+
+    @staticmethod
+    def _is_literal(value):
+        # Strings are SQL (like '?' placeholder), not values
+        return not isinstance(value, str) and not hasattr(value, 'sql')
+
+    def _route_conditions(self, query, key):
+        # Shards selected by "key = value" or "key IN (values)" conditions with
+        # literal values, all by default. Values bound from params are not known
+        shards = None
+        for condition in getattr(query, 'rows_conditions', ()):
+            if not isinstance(condition, Condition) or not self._is_key(condition.left, key):
+                continue
+            if isinstance(condition, In):
+                if condition.operator != 'IN' or hasattr(condition.right, 'sql'):
+                    continue
+                if not all(self._is_literal(value) for value in condition.right):
+                    continue
+                values = condition.right
+            elif condition.operator == '=' and self._is_literal(condition.right):
+                values = [condition.right, ]
+            else:
+                continue
+            routed = {self.shard(value) for value in values}
+            if shards is not None:
+                routed &= shards
+            shards = routed
+        if shards is None:
+            return range(len(self.shards))
+        return sorted(shards)
+
+    def _split_insert(self, query, key):
+        # Returns {shard: insert with rows for this shard}
+        names = [get_name(column) for column in query.columns]
+        if key.name not in names:
+            raise ValueError(f'Shard key {key.name} is missing in inserted columns')
+        position = names.index(key.name)
+        if not query.insert_values:
+            raise ValueError('Only inserts with values can be routed to shards')
+        rows = {}
+        for values in query.insert_values:
+            value = values[position]
+            if not self._is_literal(value):
+                raise ValueError('Shard key must be literal value, use execute_many() for parameters and text keys')
+            rows.setdefault(self.shard(value), []).append(values)
+        inserts = {}
+        for shard, values in rows.items():
+            insert = copy.copy(query)
+            insert.insert_values = Chain(values)
+            inserts[shard] = insert
+        return inserts
+
+    def _write(self, query, params):
+        key = self._shard_key(query)
+        if key is None:
+            # Replicated table, or schema query
+            queries = {shard: query for shard in range(len(self.shards))}
+        elif isinstance(query, Insert):
+            queries = self._split_insert(query, key)
+        else:
+            if isinstance(query, Update) and any(self._is_key(column, key) for column, value in query.updates):
+                raise ValueError('Shard key can not be updated')
+            queries = {shard: query for shard in self._route_conditions(query, key)}
+        futures = [
+            self._submit(shard, self._execute_write, query, params)
+            for shard, query in queries.items()
+        ]
+        rowcounts = [future.result() for future in futures]
+        if key is None:
+            # Each replica has the same rows
+            return Result.from_rows([], rowcount=rowcounts[0])
+        return Result.from_rows([], rowcount=sum(rowcounts))
+
+    @staticmethod
+    def _execute_write(db, query, params):
+        return max(db.execute_query(query, *params).rowcount, 0)
+
+    @staticmethod
+    def _fetch(db, query, params):
+        result = db.execute_query(query, *params, row_format=formats.TUPLE)
+        return result.description, result.fetchall()
+
+    def _select_shards(self, query):
+        # Queries of replicated tables only are executed on the first shard
+        tables = [get_name(getattr(table, 'target', table)) for table in query._tables()]
+        if all(table not in self.shard_keys for table in tables):
+            return [0, ]
+        key = self.shard_keys.get(get_name(query.table))
+        if key is None:
+            return range(len(self.shards))
+        return self._route_conditions(query, key)
+
+    def _select(self, query, params):
+        merge = Merge(query)
+        results = self._map(self._select_shards(query), self._fetch, merge.partial, params)
+        description = results[0][0]
+        rows = list(merge.rows(description, [rows for description, rows in results]))
+        return Result.from_rows(rows, description)
+
+    def _format(self, result, row_format):
+        row_format = row_format or self.row_format
+        if row_format == formats.COLUMNAR:
+            return formats.to_columnar(formats.column_names(result.description), result.rows)
+        factory = formats.detached_factory(row_format, formats.column_names(result.description))
+        if factory is not None:
+            result.rows = [factory(None, row) for row in result.rows]
+        return result
+
+    def execute_query(self, query, *params, row_format=None):
+        if isinstance(query, Select):
+            return self._format(self._select(query, params), row_format)
+        if isinstance(query, Exists):
+            results = self._map(self._select_shards(query.select), self._fetch, query, params)
+            return Result.from_rows(
+                [(max(rows[0][0] for description, rows in results), )],
+                results[0][0],
+            )
+        if getattr(query, 'READ_ONLY', False):
+            raise ValueError(f'{query.__class__.__name__} can not be executed on shards')
+        return self._write(query, params)
+
+    def execute_many(self, query, rows, chunk_size=None, commit=True):
+        # Rows are routed as they come, and sent to the shard when its buffer is full.
+        # Each shard executes one chunk at a time, and at most one more is waiting
+        chunk_size = chunk_size or DB.CHUNK_SIZE
+        key = self._shard_key(query)
+        if key is not None:
+            insert = getattr(query, 'query', query)
+            if not isinstance(insert, Insert):
+                raise ValueError('Only inserts can be routed to shards by rows')
+            names = [get_name(column) for column in insert.columns]
+            if key.name not in names:
+                raise ValueError(f'Shard key {key.name} is missing in inserted columns')
+            position = names.index(key.name)
+        result = BatchResult()
+        pending = {}
+
+        def submit(shard, chunk):
+            future = pending.get(shard)
+            if future is not None:
+                result.chunks.extend(future.result().chunks)
+            pending[shard] = self._submit(shard, DB.execute_many, query, chunk, chunk_size, commit)
+
+        if key is None:
+            for chunk in chunked(rows, chunk_size):
+                for shard in range(len(self.shards)):
+                    submit(shard, chunk)
+        else:
+            buffers = {}
+            for row in rows:
+                shard = self.shard(row[key.name] if isinstance(row, dict) else row[position])
+                buffer = buffers.setdefault(shard, [])
+                buffer.append(row)
+                if len(buffer) >= chunk_size:
+                    submit(shard, buffers.pop(shard))
+            for shard, buffer in buffers.items():
+                submit(shard, buffer)
+        for future in pending.values():
+            result.chunks.extend(future.result().chunks)
+        return result
+
+    def commit(self):
+        self._map(range(len(self.shards)), DB.commit)
+
+    def rollback(self):
+        self._map(range(len(self.shards)), DB.rollback)
+
+    def close(self):
+        self._map(range(len(self.shards)), DB.close)
+        for executor in self._executors:
+            executor.shutdown()
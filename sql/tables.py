@@ -11,6 +11,8 @@ log = logging.getLogger('sql.core')
 
 class Column(Field):
 
+    __slots__ = ('data_type', 'constraints', )
+
     def __init__(self, name, data_type=None, constraints=None):
         super().__init__(name=name)
         self.data_type = data_type
@@ -72,8 +74,15 @@ class Columns:
     def sql(self, **kwargs):
         return self.get_name(**kwargs)
 
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, get_name(self.__parent)), []
+
     def __getattr__(self, column):
-        return self.__columns[column]
+        # Columns might be not set yet while unpickling
+        try:
+            return self.__dict__['_Columns__columns'][column]
+        except KeyError:
+            raise AttributeError(column) from None
 
     def __iter__(self):
         yield from self.__columns.values()
@@ -94,6 +103,9 @@ class TableConstraint:
     def sql(self, **kwargs):
         return f'{self.name} ({self.columns.sql(**kwargs)})'
 
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, self.name), [self.columns, ]
+
 
 class Table(Aliasable):
 
@@ -153,6 +165,10 @@ class Table(Aliasable):
     def delete(self):
         return queries.Delete(from_table=self)
 
+    def _fingerprint_parts(self):
+        # Columns are not included, as each of them references the table
+        return (self.__class__.__name__, self.name), []
+
     def __str__(self):
         return self.name
 
@@ -174,6 +190,9 @@ class Index(Aliasable):
     def drop(self, if_not_exists=False):
         return queries.DropIndex(self, if_not_exists)
 
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, self.name, self.unique), [self.table, self.columns]
+
     def __str__(self):
         return self.name
 
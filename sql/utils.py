@@ -0,0 +1,80 @@
+import itertools
+import logging
+
+
+log = logging.getLogger('sql.utils')
+
+
+def chunked(rows, chunk_size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Chain:
+
+    # Persistent sequence, each extend() returns new chain sharing all previous items
+
+    __slots__ = ('previous', 'items', 'length', '_flat', '_fingerprints', )
+
+    def __init__(self, items=(), previous=None):
+        self.previous = previous
+        self.items = tuple(items)
+        self.length = len(self.items) + (previous.length if previous is not None else 0)
+        self._flat = None
+
+    def __reduce__(self):
+        # Pickled flat, without links to previous chains
+        return (self.__class__, (self.flat, ))
+
+    def extend(self, items):
+        return Chain(items, self)
+
+    def append(self, item):
+        return Chain((item, ), self)
+
+    @property
+    def last(self):
+        chain = self
+        while not chain.items:
+            chain = chain.previous
+        return chain.items[-1]
+
+    def replace_last(self, item):
+        if not self.items:
+            return Chain((), self.previous.replace_last(item))
+        return Chain(self.items[:-1] + (item, ), self.previous)
+
+    @property
+    def flat(self):
+        if self._flat is None:
+            groups = []
+            chain = self
+            while chain is not None and chain._flat is None:
+                groups.append(chain.items)
+                chain = chain.previous
+            if chain is not None:
+                groups.append(chain._flat)
+            self._flat = tuple(itertools.chain.from_iterable(reversed(groups)))
+        return self._flat
+
+    def _fingerprint_parts(self):
+        return (self.__class__.__name__, ), list(self.flat)
+
+    def __iter__(self):
+        return iter(self.flat)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __getitem__(self, index):
+        return self.flat[index]
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {list(self.flat)!r}>'